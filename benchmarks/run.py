@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+# Times the growth, draw, bounding box and grass stages for fixed seeds and a few
+# params presets, and prints the results as JSON. Every stage reports its rate in
+# its own units: branches and points for growing and drawing, trees for bounding
+# boxes, blades and points for grass. python_peak_bytes is what tracemalloc sees
+# (Python and NumPy, not Qt); max_rss_bytes is the high-water mark of the whole
+# process after the stage, so it only grows from one stage to the next.
+# Usage: python benchmarks/run.py [--preset dense] [--repeat 3] [--output results.json]
+
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+try:
+    import resource
+except ImportError:
+    resource = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from PyQt4.QtGui import QApplication, QGraphicsScene
+
+import numpy as np
+
+from trees import Tree, GrassDrawer, default_values, make_params
+
+presets = {
+    "sparse": dict(default_values, generations=100, branch_after_min=20, branch_after_max=40),
+    "default": dict(default_values),
+    "dense": dict(default_values, generations=300, start_branches=6, branch_after_min=8, branch_after_max=20),
+}
+
+def max_rss():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS.
+    return rss if sys.platform == "darwin" else rss * 1024
+
+def measure(function, repeat, units):
+    # Best wall time of several runs and the rate of each of units, a dict of
+    # unit name to count; the Python peak memory comes from one extra traced run.
+    seconds = []
+    for run in range(repeat):
+        start = time.time()
+        function()
+        seconds.append(time.time() - start)
+    peak = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    stage = {"seconds": min(seconds), "python_peak_bytes": peak, "max_rss_bytes": max_rss()}
+    for unit, count in units.items():
+        stage[unit + "_per_second"] = count / max(stage["seconds"], 1e-9)
+    return stage
+
+def grow_trees(values, seeds, vectorized):
+    forest = []
+    for seed in seeds:
+        tree = Tree(make_params(values, random.Random(seed)), base_location=complex(10, 0), vectorized=vectorized)
+        for iteration in tree.grow_iterations(values["generations"]):
+            pass
+        forest.append(tree)
+    return forest
+
+def draw_trees(forest, batched):
+    scene = QGraphicsScene()
+    for tree in forest:
+        tree.draw(scene, batched=batched)
+    return scene
+
+def bounding_boxes(forest):
+    return [tree.trunk.get_bounding_box() for tree in forest]
+
+def draw_grass(bounds, bundles, seed):
+    GrassDrawer(QGraphicsScene(), random.Random(seed), bounds).draw_some_grass(bundles)
+
+def run_preset(name, seeds, repeat):
+    values = presets[name]
+    forest = grow_trees(values, seeds, vectorized=False)
+    branches = sum(len(list(tree.trunk.walk())) for tree in forest)
+    points = sum(len(branch.history) for tree in forest for branch in tree.trunk.walk())
+    bounds = draw_trees(forest, batched=True).itemsBoundingRect()
+    bundles = 150 + 75*len(seeds)
+    blades = GrassDrawer(None, random.Random(seeds[0]), bounds).grass_blades(bundles)[0]
+
+    tree_units = {"branches": branches, "points": points}
+    stages = {
+        "grow": measure(lambda: grow_trees(values, seeds, vectorized=False), repeat, tree_units),
+        "grow_vectorized": measure(lambda: grow_trees(values, seeds, vectorized=True), repeat, tree_units),
+        "draw": measure(lambda: draw_trees(forest, batched=False), repeat, tree_units),
+        "draw_batched": measure(lambda: draw_trees(forest, batched=True), repeat, tree_units),
+        "bounding_box": measure(lambda: bounding_boxes(forest), repeat, {"trees": len(forest)}),
+        "grass": measure(lambda: draw_grass(bounds, bundles, seeds[0]), repeat,
+                         {"blades": blades.shape[0], "points": blades.shape[0] * blades.shape[1]}),
+    }
+    return {"preset": name, "trees": len(seeds), "branches": branches, "points": points, "stages": stages}
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the stages of tree generation.")
+    parser.add_argument("--preset", action="append", choices=sorted(presets),
+                        help="preset to run, may be repeated; default: all")
+    parser.add_argument("--trees", type=int, default=4, help="trees per preset, seeded 0, 1, ...")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="write the JSON here instead of stdout")
+    args = parser.parse_args(argv[1:])
+
+    app = QApplication(argv, False)
+    seeds = list(range(args.trees))
+    results = {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "time": time.time(),
+        "results": [run_preset(name, seeds, args.repeat) for name in args.preset or sorted(presets)],
+    }
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, "w") as output:
+            output.write(text + "\n")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+# On-disk cache of grown tree geometry. Entries are keyed by a hash of only the
+# params that influence growth, so changing color or thickness reuses them.
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+from trees import TreeGeometry
+
+growth_params = ["branch_split", "branch_after_range", "branch_split_var", "gravity",
+                 "down_die_probability", "down_damping_x", "down_damping_y",
+                 "start_branches", "keep_central", "v_start", "seed"]
+
+def growth_key(params, generations, base_location, scale, vectorized=True):
+    def plain(value):
+        if isinstance(value, complex):
+            return [value.real, value.imag]
+        return value
+    description = dict((name, plain(params[name])) for name in growth_params)
+    description["generations"] = generations
+    description["base_location"] = plain(complex(base_location))
+    description["scale"] = scale
+    description["vectorized"] = vectorized
+    return hashlib.sha1(json.dumps(description, sort_keys=True).encode("utf-8")).hexdigest()
+
+class GeometryCache:
+    # Each entry is a directory of .npy files which are memory-mapped on load.
+    # The least recently used entries are removed once max_bytes is exceeded.
+    def __init__(self, directory, max_bytes=512 * 2**20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            geometry = TreeGeometry.load(path, mmap_mode="r")
+            os.utime(path, None)
+        except (IOError, OSError):
+            return None
+        return geometry
+
+    def put(self, key, geometry):
+        staging = tempfile.mkdtemp(dir=self.directory, prefix=".")
+        geometry.save(os.path.join(staging, "entry"))
+        try:
+            os.rename(os.path.join(staging, "entry"), self.path(key))
+        except OSError:
+            # Somebody else stored the same entry meanwhile.
+            pass
+        shutil.rmtree(staging, ignore_errors=True)
+        self.evict()
+
+    def entries(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            path = self.path(name)
+            if name.startswith(".") or not os.path.isdir(path):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(path, item)) for item in os.listdir(path))
+                entries.append((os.path.getmtime(path), size, path))
+            except OSError:
+                continue
+        return entries
+
+    def evict(self):
+        entries = sorted(self.entries())
+        total = sum(size for used, size, path in entries)
+        for used, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
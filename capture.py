@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+# Records the growth animation of the dialog as a sequence of frames, without a
+# display. The forest is grown first, keeping the segments added between two
+# frames; they are then painted one frame at a time onto a single image, so each
+# frame only costs its own segments. Worker processes encode the frames.
+# Usage: python capture.py [params.json] --seed 1 --every 2 --output frames/
+#        python capture.py --format raw --output frames.rgba
+#        ffmpeg -f rawvideo -pix_fmt rgba -s 1200x800 -r 30 -i frames.rgba forest.mp4
+
+import argparse
+import collections
+import multiprocessing
+import os
+import random
+import sys
+
+from PyQt4.QtGui import QApplication, QImage, QPainter, QPen, QColor
+
+import numpy as np
+
+from trees import Tree, GrassDrawer, make_params, plan_forest, polygon_from_points, image_shape
+from render import load_values, forest_bounds, frame_bounds, paint_background, set_view, parse_shape
+
+def grow_frames(values, seed, every=1):
+    # Grows the trees one after another like the dialog does; returns the trees
+    # and a list of (params, SegmentBatch) with what each frame adds.
+    rng = random.Random(seed)
+    trees = []
+    frames = []
+    for tree_index, (base_location, scale) in enumerate(plan_forest(values["tree_count"], rng)):
+        params = make_params(values, rng)
+        tree = Tree(params, base_location=base_location, scale=scale)
+        tree.record_segments(tree_index)
+        trees.append(tree)
+        for iteration in tree.grow_iterations(values["generations"], every):
+            frames.append((params, tree.take_segments()))
+        batch = tree.take_segments()
+        if len(batch) > 0:
+            frames.append((params, batch))
+    return trees, frames
+
+class FrameRenderer:
+    # A persistent image of the animation so far, seen through a fixed frame.
+    def __init__(self, trees, shape):
+        self.shape = shape
+        self.image = QImage(shape[0], shape[1], QImage.Format_ARGB32)
+        self.painter = QPainter(self.image)
+        self.painter.setRenderHint(QPainter.Antialiasing)
+        paint_background(self.painter, shape)
+        self.bounds = forest_bounds(trees)
+        set_view(self.painter, frame_bounds(self.bounds, shape), shape)
+
+    def add(self, params, batch):
+        for generation, length, points in batch.polylines():
+            self.painter.setPen(params["style"].pen(generation, length))
+            self.painter.drawPolyline(polygon_from_points(points))
+
+    def add_grass(self, rng, bundles, alpha_step=10):
+        blades, alpha = GrassDrawer(None, rng, self.bounds.scene_rect()).grass_blades(bundles)
+        alpha = (np.round(alpha / alpha_step) * alpha_step).astype(int)
+        for level in np.unique(alpha):
+            self.painter.setPen(QPen(QColor(180, 180, 180, min(255, int(level)))))
+            for blade in blades[alpha == level]:
+                self.painter.drawPolyline(polygon_from_points(blade, flip_y=False))
+
+    def pixels(self):
+        # A copy of the image as bytes, B, G, R, A on little endian machines.
+        buffer = self.image.bits()
+        buffer.setsize(self.image.byteCount())
+        return np.frombuffer(buffer, dtype=np.uint8).tobytes()
+
+    def end(self):
+        self.painter.end()
+
+def encode_frame(job):
+    format, path, shape, pixels = job
+    if format == "png":
+        image = QImage(pixels, shape[0], shape[1], QImage.Format_ARGB32)
+        if not image.save(path):
+            raise IOError("could not write {0}".format(path))
+        return None
+    return np.frombuffer(pixels, dtype=np.uint8).reshape(-1, 4)[:, [2, 1, 0, 3]].tobytes()
+
+def capture(values, seed, shape, format, output, every=1, processes=None, grass=True):
+    trees, frames = grow_frames(values, seed, every)
+    renderer = FrameRenderer(trees, shape)
+    if format == "png":
+        if not os.path.isdir(output):
+            os.makedirs(output)
+        stream = None
+    elif output == "-":
+        stream = getattr(sys.stdout, "buffer", sys.stdout)
+    else:
+        stream = open(output, "wb")
+
+    def frame_jobs():
+        for index, (params, batch) in enumerate(frames):
+            renderer.add(params, batch)
+            if grass and index == len(frames) - 1:
+                renderer.add_grass(random.Random(seed), 150 + 75*values["tree_count"])
+            path = os.path.join(output, "frame-{0:06d}.png".format(index)) if format == "png" else None
+            yield format, path, shape, renderer.pixels()
+
+    # A few frames in flight per worker keep them busy without holding the whole animation.
+    pool = multiprocessing.Pool(processes)
+    pending = collections.deque()
+    limit = 4 * (processes or multiprocessing.cpu_count())
+    try:
+        for job in frame_jobs():
+            pending.append(pool.apply_async(encode_frame, (job,)))
+            while len(pending) >= limit or (pending and pending[0].ready()):
+                data = pending.popleft().get()
+                if stream is not None:
+                    stream.write(data)
+        while pending:
+            data = pending.popleft().get()
+            if stream is not None:
+                stream.write(data)
+    finally:
+        pool.close()
+        pool.join()
+        renderer.end()
+        if stream is not None and output != "-":
+            stream.close()
+    return len(frames)
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Record the growth animation as PNG frames or raw RGBA video.")
+    parser.add_argument("params", nargs="?", help="JSON file with dialog values, missing ones use the defaults")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--every", type=int, default=1, help="growth iterations per frame")
+    parser.add_argument("--size", type=parse_shape, default=image_shape, help="WIDTHxHEIGHT")
+    parser.add_argument("--format", choices=["png", "raw"], default="png")
+    parser.add_argument("--output", help="directory of PNG frames or raw file, - for stdout; "
+                                         "default: frames/ or frames.rgba")
+    parser.add_argument("--trees", type=int, help="overrides tree_count")
+    parser.add_argument("--generations", type=int, help="overrides generations")
+    parser.add_argument("--processes", type=int, help="worker processes encoding frames, default: all cores")
+    parser.add_argument("--no-grass", action="store_true", help="leave out the grass of the last frame")
+    args = parser.parse_args(argv[1:])
+
+    values = load_values(args.params)
+    if args.trees is not None:
+        values["tree_count"] = args.trees
+    if args.generations is not None:
+        values["generations"] = args.generations
+    output = args.output
+    if output is None:
+        output = "frames" if args.format == "png" else "frames.rgba"
+
+    app = QApplication(argv, False)
+    count = capture(values, args.seed, args.size, args.format, output, args.every, args.processes,
+                    not args.no_grass)
+    sys.stderr.write("{0} frames of {1}x{2}\n".format(count, args.size[0], args.size[1]))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
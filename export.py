@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+
+# Writes grown trees as SVG or as a compact binary geometry file, one branch
+# at a time straight from the branch histories, without a QGraphicsScene.
+# Usage: python export.py [params.json] --seed 1 --format svg --output forest.svg
+#
+# The binary format is the magic b"TREEGEO1" followed by one record per branch:
+# a little endian header of tree index, generation and point count (uint32),
+# pen width (float32) and pen color as r, g, b, a bytes, then the points as
+# count rows of x, y float32. Like on screen, y points up. A pen width of 0
+# means a cosmetic line, one pixel (or device unit) wide at any scale, as in Qt.
+
+import argparse
+import multiprocessing
+import os
+import random
+import shutil
+import struct
+import sys
+import tempfile
+
+import numpy as np
+
+from trees import Tree, TreeStyle, make_params
+from forest import grow_tree, plan_jobs
+from cache import GeometryCache
+from render import load_values, forest_bounds
+
+magic = b"TREEGEO1"
+record_header = struct.Struct("<IIIf4B")
+
+def branch_records(tree, params=None):
+    # Yields (generation, pen, points) for every branch of a Tree or a
+    # TreeGeometry, with the points that drawing would use. A Tree brings its
+    # own params and may have packed branches, a TreeGeometry takes the
+    # rendering ones from params.
+    if isinstance(tree, Tree):
+        style = tree.trunk.params["style"]
+        for record in tree.packed.geometry().lines(style):
+            yield record
+        for branch in tree.trunk.walk():
+            points = branch.history.points()
+            pen = style.pen(branch.generation, len(points))
+            yield branch.generation, pen, points[:max(1, len(points) - 1)]
+    else:
+        for record in tree.lines(TreeStyle(params, tree.scale)):
+            yield record
+
+class SvgWriter:
+    def __init__(self, stream, bounds, precision=2):
+        self.stream = stream
+        self.point_format = "{{0:.{0}f}},{{1:.{0}f}}".format(precision)
+        bounds = bounds.copy()
+        bounds.enlarge(10)
+        width, height = bounds.size()
+        self.stream.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        self.stream.write('<svg xmlns="http://www.w3.org/2000/svg" viewBox="{0} {1} {2} {3}">\n'.format(
+            bounds.xmin, -bounds.ymax, width, height))
+        self.stream.write('<g fill="none" stroke-linejoin="round">\n')
+
+    def write_branch(self, generation, pen, points):
+        if len(points) < 2:
+            return
+        # SVG has y pointing down.
+        coordinates = " ".join(map(self.point_format.format, points[:, 0], -points[:, 1]))
+        if pen.widthF() == 0:
+            # Qt draws width 0 pens one pixel wide whatever the scale.
+            stroke = 'stroke-width="1" vector-effect="non-scaling-stroke"'
+        else:
+            stroke = 'stroke-width="{0:.3f}"'.format(pen.widthF())
+        self.stream.write('<polyline class="g{0}" stroke="{1}" {2} points="{3}"/>\n'.format(
+            generation, pen.color().name(), stroke, coordinates))
+
+    def write_tree(self, records):
+        self.stream.write('<g>\n')
+        for generation, pen, points in records:
+            self.write_branch(generation, pen, points)
+        self.stream.write('</g>\n')
+
+    def close(self):
+        self.stream.write('</g>\n</svg>\n')
+
+class GeometryWriter:
+    def __init__(self, stream):
+        self.stream = stream
+        self.tree_index = 0
+        self.stream.write(magic)
+
+    def write_branch(self, generation, pen, points):
+        color = pen.color()
+        self.stream.write(record_header.pack(self.tree_index, int(generation), len(points), pen.widthF(),
+                                             color.red(), color.green(), color.blue(), color.alpha()))
+        self.stream.write(np.asarray(points, dtype="<f4").tobytes())
+
+    def write_tree(self, records):
+        for generation, pen, points in records:
+            self.write_branch(generation, pen, points)
+        self.tree_index += 1
+
+    def close(self):
+        pass
+
+def read_geometry(stream):
+    # Yields (tree index, generation, pen width, (r, g, b, a), points) per branch.
+    if stream.read(len(magic)) != magic:
+        raise ValueError("not a tree geometry file")
+    while True:
+        header = stream.read(record_header.size)
+        if not header:
+            return
+        if len(header) < record_header.size:
+            raise ValueError("truncated tree geometry file")
+        tree_index, generation, count, width, r, g, b, a = record_header.unpack(header)
+        data = stream.read(count * 8)
+        if len(data) < count * 8:
+            raise ValueError("truncated tree geometry file")
+        points = np.frombuffer(data, dtype="<f4").reshape(count, 2)
+        yield tree_index, generation, width, (r, g, b, a), points
+
+formats = ["bin", "svg"]
+
+def export_forest(forest, path, format="svg", params=None, bounds=None):
+    # forest holds Trees or TreeGeometry objects; the latter are drawn with params.
+    # It is only walked once, so it may be an iterator if the SVG bounds are given.
+    with open(path, "w" if format == "svg" else "wb") as stream:
+        if format == "svg":
+            writer = SvgWriter(stream, bounds if bounds is not None else forest_bounds(forest))
+        else:
+            writer = GeometryWriter(stream)
+        for tree in forest:
+            writer.write_tree(branch_records(tree, params))
+        writer.close()
+
+def tree_bounds(job):
+    # Grows a tree into the cache of the job and returns only its bounding box.
+    return grow_tree(job).get_bounding_box()
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Export forests as SVG or binary geometry.")
+    parser.add_argument("params", nargs="?", help="JSON file with dialog values, missing ones use the defaults")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--format", choices=formats, default="svg")
+    parser.add_argument("--trees", type=int, help="overrides tree_count")
+    parser.add_argument("--generations", type=int, help="overrides generations")
+    parser.add_argument("--processes", type=int, help="worker processes growing trees, default: all cores")
+    parser.add_argument("--cache-dir", help="reuse grown geometry stored in this directory")
+    parser.add_argument("--output", help="default: forest.svg or forest.bin")
+    args = parser.parse_args(argv[1:])
+
+    values = load_values(args.params)
+    if args.trees is not None:
+        values["tree_count"] = args.trees
+    if args.generations is not None:
+        values["generations"] = args.generations
+
+    output = args.output if args.output is not None else "forest." + args.format
+    cache = GeometryCache(args.cache_dir) if args.cache_dir is not None else None
+    # Trees are written as they come in, so only a few are held at a time. The SVG
+    # header needs the bounds of the whole forest first: its trees are grown into
+    # the cache, a temporary one without --cache-dir, and read back one by one.
+    staging = None
+    if cache is None and args.format == "svg":
+        staging = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(output)), prefix=".export-")
+        cache = GeometryCache(staging, max_bytes=float("inf"))
+    jobs = plan_jobs(values, args.seed, cache)
+    pool = multiprocessing.Pool(args.processes)
+    try:
+        if args.format == "svg":
+            boxes = pool.map(tree_bounds, jobs, chunksize=1)
+            bounds = boxes[0]
+            for box in boxes[1:]:
+                bounds.grow_to(box)
+            forest = (grow_tree(job) for job in jobs)
+        else:
+            bounds = None
+            forest = pool.imap(grow_tree, jobs, chunksize=1)
+        export_forest(forest, output, args.format, make_params(values, random.Random()), bounds)
+    finally:
+        pool.close()
+        pool.join()
+        if staging is not None:
+            shutil.rmtree(staging, ignore_errors=True)
+    print(output)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
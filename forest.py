@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+
+# Grows the trees of a forest in a process pool. Every tree gets its own seed
+# derived from the master seed, so the result does not depend on the pool size.
+
+import random
+
+from trees import Tree, TreeGeometry, make_params, plan_forest
+from cache import growth_key
+
+def grow_tree(job):
+    values, base_location, scale, seed, cache = job
+    params = make_params(values, random.Random(seed))
+    if cache is not None:
+        key = growth_key(params, values["generations"], base_location, scale)
+        geometry = cache.get(key)
+        if geometry is not None:
+            return geometry
+    tree = Tree(params, base_location=base_location, scale=scale, vectorized=True)
+    for iteration in tree.grow_iterations(values["generations"]):
+        pass
+    geometry = TreeGeometry.from_tree(tree)
+    if cache is not None:
+        cache.put(key, geometry)
+    return geometry
+
+def plan_jobs(values, master_seed, cache=None):
+    rng = random.Random(master_seed)
+    layout = plan_forest(values["tree_count"], rng)
+    return [(values, base_location, scale, rng.getrandbits(32), cache) for base_location, scale in layout]
+
+def grow_forest(values, master_seed, pool=None, cache=None):
+    jobs = plan_jobs(values, master_seed, cache)
+    if pool is None:
+        return [grow_tree(job) for job in jobs]
+    return pool.map(grow_tree, jobs, chunksize=1)
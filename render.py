@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+# Renders forests straight into image files, without the dialog or a QGraphicsScene.
+# Usage: python render.py [params.json] --seed 1 --count 10 --output-dir out/
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import sys
+
+from PyQt4.QtCore import QPointF
+from PyQt4.QtGui import QApplication, QImage, QPainter, QColor, QLinearGradient, QBrush
+
+from trees import default_values, make_params, image_shape
+from forest import grow_forest
+from cache import GeometryCache
+
+def load_values(path=None):
+    values = dict(default_values)
+    if path is not None:
+        with open(path) as params_file:
+            values.update(json.load(params_file))
+    return values
+
+def forest_bounds(forest):
+    bounds = forest[0].get_bounding_box()
+    for tree in forest[1:]:
+        bounds.grow_to(tree.get_bounding_box())
+    return bounds
+
+def frame_bounds(bounds, shape):
+    bounds = bounds.copy()
+    bounds.enlarge(10)
+    bounds.fix_aspect_ratio((float(shape[0]), float(shape[1])))
+    return bounds
+
+def paint_background(painter, shape):
+    gradient = QLinearGradient(QPointF(0, 0), QPointF(0, shape[1]))
+    gradient.setColorAt(0.4, QColor(0, 0, 0))
+    gradient.setColorAt(0, QColor(25, 25, 25))
+    painter.fillRect(0, 0, shape[0], shape[1], QBrush(gradient))
+
+def set_view(painter, bounds, shape):
+    # Maps tree coordinates inside bounds onto the image; y points up in the trees.
+    factor = shape[0] / bounds.size()[0]
+    painter.scale(factor, factor)
+    painter.translate(-bounds.xmin, bounds.ymax)
+    return factor
+
+def render_forest(forest, params, shape=image_shape, lod=False):
+    image = QImage(shape[0], shape[1], QImage.Format_ARGB32_Premultiplied)
+    painter = QPainter(image)
+    painter.setRenderHint(QPainter.Antialiasing)
+    paint_background(painter, shape)
+    factor = set_view(painter, frame_bounds(forest_bounds(forest), shape), shape)
+    pixel_size = 1.0 / factor if lod else None
+    for geometry in forest:
+        geometry.paint(painter, params, pixel_size)
+    painter.end()
+    return image
+
+def parse_shape(text):
+    width, height = text.lower().split("x")
+    return int(width), int(height)
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Render forests to PNG files without a display.")
+    parser.add_argument("params", nargs="?", help="JSON file with dialog values, missing ones use the defaults")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the first image")
+    parser.add_argument("--count", type=int, default=1, help="number of images, seeds count up from --seed")
+    parser.add_argument("--output-dir", default=".")
+    parser.add_argument("--size", type=parse_shape, default=image_shape, help="WIDTHxHEIGHT")
+    parser.add_argument("--trees", type=int, help="overrides tree_count")
+    parser.add_argument("--generations", type=int, help="overrides generations")
+    parser.add_argument("--processes", type=int, help="worker processes growing trees, default: all cores")
+    parser.add_argument("--lod", action="store_true",
+                        help="simplify branches to the pixel size and skip those thinner than a pixel")
+    parser.add_argument("--cache-dir", help="reuse grown geometry stored in this directory")
+    parser.add_argument("--cache-size", type=int, default=512, help="cache size limit in MiB")
+    args = parser.parse_args(argv[1:])
+
+    values = load_values(args.params)
+    if args.trees is not None:
+        values["tree_count"] = args.trees
+    if args.generations is not None:
+        values["generations"] = args.generations
+
+    # No GUI: works without a display.
+    app = QApplication(argv, False)
+    if not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+    cache = None
+    if args.cache_dir is not None:
+        cache = GeometryCache(args.cache_dir, args.cache_size * 2**20)
+    params = make_params(values, random.Random())
+    pool = multiprocessing.Pool(args.processes)
+    try:
+        for seed in range(args.seed, args.seed + args.count):
+            image = render_forest(grow_forest(values, seed, pool, cache), params, args.size, args.lod)
+            path = os.path.join(args.output_dir, "forest-{0:06d}.png".format(seed))
+            if not image.save(path):
+                sys.stderr.write("Could not write {0}\n".format(path))
+                return 1
+            print(path)
+    finally:
+        pool.close()
+        pool.join()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+
+# Renders a thumbnail for every combination of a grid or a random sample of
+# dialog values, then a contact sheet and an index.json describing them.
+# Variants which only differ in how trees are drawn share one grown forest.
+# Usage: python sweep.py [params.json] --vary gravity=0.02,0.04 --vary r=0.5,1 --output-dir sweep/
+#        python sweep.py --random gravity=0.01:0.06 --random keep_central=0:0.3 --samples 100
+
+import argparse
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+
+from PyQt4.QtCore import Qt
+from PyQt4.QtGui import QApplication, QImage, QPainter, QColor
+
+from trees import default_values, drawing_values, make_params
+from forest import grow_forest
+from cache import GeometryCache
+from render import load_values, render_forest, parse_shape
+
+def parse_value(name, text):
+    if name not in default_values:
+        raise argparse.ArgumentTypeError("unknown value {0}".format(name))
+    return type(default_values[name])(text)
+
+def parse_grid(text):
+    name, choices = text.split("=", 1)
+    return name, [parse_value(name, choice) for choice in choices.split(",")]
+
+def parse_range(text):
+    name, bounds = text.split("=", 1)
+    low, high = bounds.split(":")
+    return name, (parse_value(name, low), parse_value(name, high))
+
+def grid_variants(base, grid):
+    names = [name for name, choices in grid]
+    for combination in itertools.product(*[choices for name, choices in grid]):
+        values = dict(base)
+        values.update(zip(names, combination))
+        yield values
+
+def random_variants(base, ranges, samples, rng):
+    for sample in range(samples):
+        values = dict(base)
+        for name, (low, high) in ranges:
+            if isinstance(default_values[name], int):
+                values[name] = rng.randint(low, high)
+            else:
+                values[name] = rng.uniform(low, high)
+        yield values
+
+def growth_group(values):
+    return json.dumps(dict((name, value) for name, value in values.items() if name not in drawing_values),
+                      sort_keys=True)
+
+def grow_group(job):
+    # Grows the forest of a group into the cache, where its variants find it.
+    seed, values, cache = job
+    grow_forest(values, seed, cache=cache)
+    return growth_group(values)
+
+def render_variant(job):
+    seed, index, values, shape, output_dir, cache = job
+    forest = grow_forest(values, seed, cache=cache)
+    image = render_forest(forest, make_params(values, random.Random()), shape, lod=True)
+    path = os.path.join(output_dir, "variant-{0:05d}.png".format(index))
+    if not image.save(path):
+        raise IOError("could not write {0}".format(path))
+    return index, path
+
+def contact_sheet(paths, shape, columns):
+    rows = (len(paths) + columns - 1) // columns
+    sheet = QImage(columns * shape[0], rows * shape[1], QImage.Format_ARGB32_Premultiplied)
+    sheet.fill(QColor(0, 0, 0).rgba())
+    painter = QPainter(sheet)
+    painter.setPen(QColor(200, 200, 200))
+    for position, (index, path) in enumerate(paths):
+        left, top = position % columns * shape[0], position // columns * shape[1]
+        painter.drawImage(left, top, QImage(path))
+        painter.drawText(left + 4, top + 4, shape[0] - 8, shape[1] - 8, Qt.AlignLeft | Qt.AlignTop, str(index))
+    painter.end()
+    return sheet
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Render thumbnails over a grid or random sample of dialog values.")
+    parser.add_argument("params", nargs="?", help="JSON file with the values not swept, missing ones use the defaults")
+    parser.add_argument("--vary", type=parse_grid, action="append", default=[], metavar="NAME=V1,V2,...",
+                        help="grid over these values, may be repeated")
+    parser.add_argument("--random", type=parse_range, action="append", default=[], metavar="NAME=LOW:HIGH",
+                        help="sample uniformly from this range, may be repeated")
+    parser.add_argument("--samples", type=int, default=100, help="random samples drawn for every grid combination")
+    parser.add_argument("--seed", type=int, default=0, help="forest seed shared by all variants")
+    parser.add_argument("--size", type=parse_shape, default=(240, 120), help="thumbnail WIDTHxHEIGHT")
+    parser.add_argument("--columns", type=int, help="thumbnails per row of the contact sheet")
+    parser.add_argument("--processes", type=int, help="worker processes, default: all cores")
+    parser.add_argument("--cache-dir", help="reuse grown geometry stored in this directory")
+    parser.add_argument("--output-dir", default="sweep")
+    args = parser.parse_args(argv[1:])
+
+    base = load_values(args.params)
+    rng = random.Random(args.seed)
+    variants = []
+    for values in grid_variants(base, args.vary):
+        if args.random:
+            variants.extend(random_variants(values, args.random, args.samples, rng))
+        else:
+            variants.append(values)
+
+    groups = {}
+    for index, values in enumerate(variants):
+        groups.setdefault(growth_group(values), []).append((index, values))
+
+    app = QApplication(argv, False)
+    if not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+    # Every group is grown once, then its variants are drawn in parallel from the
+    # cache, a temporary one unless --cache-dir is given.
+    staging = None
+    if args.cache_dir is None:
+        staging = tempfile.mkdtemp(dir=args.output_dir, prefix=".forests-")
+    cache = GeometryCache(args.cache_dir if staging is None else staging)
+    grow_jobs = [(args.seed, group[0][1], cache) for group in groups.values()]
+    pool = multiprocessing.Pool(args.processes)
+    paths = []
+    try:
+        rendering = []
+        for key in pool.imap_unordered(grow_group, grow_jobs):
+            rendering.extend(pool.apply_async(render_variant,
+                                              ((args.seed, index, values, args.size, args.output_dir, cache),))
+                             for index, values in groups[key])
+        for result in rendering:
+            paths.append(result.get())
+            sys.stderr.write("{0}/{1} variants\n".format(len(paths), len(variants)))
+    finally:
+        pool.close()
+        pool.join()
+        if staging is not None:
+            shutil.rmtree(staging, ignore_errors=True)
+    paths.sort()
+
+    columns = args.columns or int(math.ceil(math.sqrt(len(paths))))
+    sheet_path = os.path.join(args.output_dir, "sheet.png")
+    if not contact_sheet(paths, args.size, columns).save(sheet_path):
+        sys.stderr.write("Could not write {0}\n".format(sheet_path))
+        return 1
+    swept = [name for name, choices in args.vary] + [name for name, bounds in args.random]
+    index = {
+        "seed": args.seed,
+        "sheet": os.path.basename(sheet_path),
+        "columns": columns,
+        "thumbnail_size": list(args.size),
+        "swept": swept,
+        "variants": [{"index": index, "file": os.path.basename(path), "values": variants[index],
+                      "swept": dict((name, variants[index][name]) for name in swept)}
+                     for index, path in paths],
+    }
+    with open(os.path.join(args.output_dir, "index.json"), "w") as index_file:
+        json.dump(index, index_file, indent=1, sort_keys=True)
+    print(sheet_path)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
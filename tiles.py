@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+# Renders a forest into a large RGBA image on disk tile by tile, so memory is
+# bounded by the tile size. The trees are stored next to the output first and
+# memory-mapped by the workers; each tile only paints the trees and branches
+# whose bounding boxes reach into it. The output is a .npy file of shape (height, width, 4).
+# Usage: python tiles.py [params.json] --seed 1 --trees 60 --size 24000x8000 --output poster.npy
+
+import argparse
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+
+from PyQt4.QtGui import QApplication, QImage, QPainter
+
+import numpy as np
+
+from trees import Box, TreeGeometry, make_params
+from forest import grow_forest
+from cache import GeometryCache
+from render import load_values, forest_bounds, frame_bounds, paint_background, set_view, parse_shape
+
+def tiles(shape, tile_size):
+    for top in range(0, shape[1], tile_size):
+        for left in range(0, shape[0], tile_size):
+            yield left, top, min(tile_size, shape[0] - left), min(tile_size, shape[1] - top)
+
+def store_forest(forest, directory):
+    # Saves every tree with its branch bounds into a directory of its own.
+    directories = []
+    for index, geometry in enumerate(forest):
+        path = os.path.join(directory, str(index))
+        geometry.save(path)
+        np.save(os.path.join(path, "branch_bounds.npy"), geometry.branch_bounds())
+        directories.append(path)
+    return directories
+
+class TileRenderer:
+    # Paints tiles of the frame from trees stored by store_forest(), memory-mapped.
+    def __init__(self, directories, values, shape, frame, lod=False):
+        self.forest = [TreeGeometry.load(path, mmap_mode="r") for path in directories]
+        self.branch_bounds = [np.load(os.path.join(path, "branch_bounds.npy"), mmap_mode="r")
+                              for path in directories]
+        self.tree_bounds = [Box(bounds[:, 0].min(), bounds[:, 1].max(), bounds[:, 2].min(), bounds[:, 3].max())
+                            for bounds in self.branch_bounds]
+        self.params = make_params(values, random.Random())
+        self.shape = shape
+        self.lod = lod
+        self.frame = frame
+        self.factor = shape[0] / self.frame.size()[0]
+        # Pens are at most this wide, in tree coordinates (see branch_pen).
+        max_scale = max(geometry.scale for geometry in self.forest)
+        self.margin = self.params["painter_thickness"] * ((max_scale - 1) * 3 + 1)
+
+    def tile_box(self, left, top, width, height):
+        # The part of the frame covered by the tile, in tree coordinates, plus a pen width.
+        return Box(self.frame.xmin + left / self.factor - self.margin,
+                   self.frame.xmin + (left + width) / self.factor + self.margin,
+                   self.frame.ymax - (top + height) / self.factor - self.margin,
+                   self.frame.ymax - top / self.factor + self.margin)
+
+    def visible_branches(self, index, box):
+        bounds = self.branch_bounds[index]
+        return np.flatnonzero((bounds[:, 0] <= box.xmax) & (box.xmin <= bounds[:, 1]) &
+                              (bounds[:, 2] <= box.ymax) & (box.ymin <= bounds[:, 3]))
+
+    def render_tile(self, left, top, width, height):
+        image = QImage(width, height, QImage.Format_ARGB32)
+        painter = QPainter(image)
+        painter.setRenderHint(QPainter.Antialiasing)
+        painter.translate(-left, -top)
+        paint_background(painter, self.shape)
+        set_view(painter, self.frame, self.shape)
+        box = self.tile_box(left, top, width, height)
+        pixel_size = 1.0 / self.factor if self.lod else None
+        for index, geometry in enumerate(self.forest):
+            if self.tree_bounds[index].intersects(box):
+                geometry.paint(painter, self.params, pixel_size, self.visible_branches(index, box))
+        painter.end()
+        return image_to_rgba(image)
+
+def image_to_rgba(image):
+    buffer = image.bits()
+    buffer.setsize(image.byteCount())
+    rows = np.frombuffer(buffer, dtype=np.uint8).reshape(image.height(), image.bytesPerLine() // 4, 4)
+    # Format_ARGB32 is stored as BGRA on little endian machines.
+    return rows[:, :image.width(), [2, 1, 0, 3]].copy()
+
+renderer = None
+
+def init_worker(directories, values, shape, frame, lod):
+    global renderer
+    renderer = TileRenderer(directories, values, shape, frame, lod)
+
+def render_tile(job):
+    output, left, top, width, height = job
+    target = np.load(output, mmap_mode="r+")
+    target[top:top + height, left:left + width] = renderer.render_tile(left, top, width, height)
+    target.flush()
+    return left, top
+
+def render_tiled(forest, values, shape, output, tile_size=1024, processes=None, lod=False):
+    frame = frame_bounds(forest_bounds(forest), shape)
+    target = np.lib.format.open_memmap(output, mode="w+", dtype=np.uint8, shape=(shape[1], shape[0], 4))
+    del target
+    staging = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(output)), prefix=".tiles-")
+    try:
+        directories = store_forest(forest, staging)
+        jobs = [(output,) + tile for tile in tiles(shape, tile_size)]
+        pool = multiprocessing.Pool(processes, init_worker, (directories, values, shape, frame, lod))
+        try:
+            for done in pool.imap_unordered(render_tile, jobs):
+                pass
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Render a large forest tile by tile into a .npy RGBA image.")
+    parser.add_argument("params", nargs="?", help="JSON file with dialog values, missing ones use the defaults")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--size", type=parse_shape, default=(8000, 4000), help="WIDTHxHEIGHT")
+    parser.add_argument("--tile", type=int, default=1024, help="tile edge in pixels")
+    parser.add_argument("--trees", type=int, help="overrides tree_count")
+    parser.add_argument("--generations", type=int, help="overrides generations")
+    parser.add_argument("--processes", type=int, help="worker processes, default: all cores")
+    parser.add_argument("--lod", action="store_true")
+    parser.add_argument("--cache-dir", help="reuse grown geometry stored in this directory")
+    parser.add_argument("--output", default="forest.npy")
+    args = parser.parse_args(argv[1:])
+
+    values = load_values(args.params)
+    if args.trees is not None:
+        values["tree_count"] = args.trees
+    if args.generations is not None:
+        values["generations"] = args.generations
+
+    app = QApplication(argv, False)
+    cache = GeometryCache(args.cache_dir) if args.cache_dir is not None else None
+    pool = multiprocessing.Pool(args.processes)
+    try:
+        forest = grow_forest(values, args.seed, pool, cache)
+    finally:
+        pool.close()
+        pool.join()
+    render_tiled(forest, values, args.size, args.output, args.tile, args.processes, args.lod)
+    print(args.output)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -91,9 +91,7 @@ class Ui_Dialog(object):
         self.label_6.setObjectName(_fromUtf8("label_6"))
         self.formLayout_2.setWidget(6, QtGui.QFormLayout.LabelRole, self.label_6)
         self.repaint = QtGui.QSpinBox(Dialog)
-        self.repaint.setMinimum(1)
         self.repaint.setMaximum(250)
-        self.repaint.setProperty("value", 14)
         self.repaint.setObjectName(_fromUtf8("repaint"))
         self.formLayout_2.setWidget(6, QtGui.QFormLayout.FieldRole, self.repaint)
         self.label_20 = QtGui.QLabel(Dialog)
@@ -277,6 +275,9 @@ class Ui_Dialog(object):
         self.draw_buton.setSizePolicy(sizePolicy)
         self.draw_buton.setObjectName(_fromUtf8("draw_buton"))
         self.horizontalLayout_7.addWidget(self.draw_buton)
+        self.live_preview = QtGui.QCheckBox(Dialog)
+        self.live_preview.setObjectName(_fromUtf8("live_preview"))
+        self.horizontalLayout_7.addWidget(self.live_preview)
         self.progress = QtGui.QLabel(Dialog)
         self.progress.setObjectName(_fromUtf8("progress"))
         self.horizontalLayout_7.addWidget(self.progress)
@@ -296,6 +297,7 @@ class Ui_Dialog(object):
         self.label_5.setText(_translate("Dialog", "gravity: pull down branches", None))
         self.label.setText(_translate("Dialog", "do generations", None))
         self.label_6.setText(_translate("Dialog", "repaint every", None))
+        self.repaint.setSpecialValueText(_translate("Dialog", "auto", None))
         self.label_20.setText(_translate("Dialog", "color base + walk speed", None))
         self.label_7.setText(_translate("Dialog", "down_damping: when branch down", None))
         self.label_8.setText(_translate("Dialog", "x", None))
@@ -312,5 +314,6 @@ class Ui_Dialog(object):
         self.label_19.setText(_translate("Dialog", "painter thickness / generations", None))
         self.label_21.setText(_translate("Dialog", "Trees:", None))
         self.draw_buton.setText(_translate("Dialog", "Redraw", None))
+        self.live_preview.setText(_translate("Dialog", "Live preview", None))
         self.progress.setText(_translate("Dialog", "Done.", None))
 
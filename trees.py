@@ -1,9 +1,15 @@
 # -*- coding: utf-8 -*-
 
+import os
 import random
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 from PyQt4 import Qt
-from PyQt4.QtCore import QPoint, QObject, QPointF, QLineF, QEventLoop
+from PyQt4.QtCore import QObject, QPointF, QRectF, QEventLoop, QThread, QTimer
 
 from PyQt4.QtGui import QImage, QPainter, QColor, QPolygon
 from PyQt4.QtGui import QLabel, QApplication, QPixmap, QMainWindow, QPushButton, QVBoxLayout, QWidget, QDialog
@@ -26,6 +32,28 @@ class Box:
         self.ymin = self.ymin if self.ymin < other.ymin else other.ymin
         self.ymax = self.ymax if self.ymax > other.ymax else other.ymax
 
+    def grow_to_point(self, point):
+        x, y = point.real, point.imag
+        self.xmin = self.xmin if self.xmin < x else x
+        self.xmax = self.xmax if self.xmax > x else x
+        self.ymin = self.ymin if self.ymin < y else y
+        self.ymax = self.ymax if self.ymax > y else y
+
+    def copy(self):
+        return Box(self.xmin, self.xmax, self.ymin, self.ymax)
+
+    def intersects(self, other):
+        return self.xmin <= other.xmax and other.xmin <= self.xmax \
+           and self.ymin <= other.ymax and other.ymin <= self.ymax
+
+    def contains(self, other):
+        return self.xmin <= other.xmin and other.xmax <= self.xmax \
+           and self.ymin <= other.ymin and other.ymax <= self.ymax
+
+    def scene_rect(self):
+        # The box in scene coordinates, where y points down.
+        return QRectF(self.xmin, -self.ymax, self.size()[0], self.size()[1])
+
     def enlarge(self, by_percent):
         f = by_percent / 100.0 / 2.0
         self.xmin -= self.size()[0] * f
@@ -41,7 +69,7 @@ class Box:
             self.xmax += 0.5*corr
             self.xmin -= 0.5*corr
         else:
-            self.ymax += (self.size()[0] * (current-target))
+            self.ymax += self.size()[0] / target - self.size()[1]
     
     def __getitem__(self, *args):
         return [[self.xmin, self.xmax], [self.ymin, self.ymax]][args[0]][args[1]]
@@ -52,19 +80,260 @@ class Box:
     def __repr__(self):
         return "({0}, {1}) -> ({2}, {3})".format(self.xmin, self.ymin, self.xmax, self.ymax)
 
+def polygon_from_points(points, flip_y=True):
+    # Copies the (x, y) rows straight into the polygon's storage, flipping y for the scene.
+    polygon = QPolygonF(len(points))
+    buffer = polygon.data()
+    buffer.setsize(len(points) * 2 * np.dtype(np.float64).itemsize)
+    target = np.frombuffer(buffer, dtype=np.float64).reshape(-1, 2)
+    target[:, 0] = points[:, 0]
+    target[:, 1] = -points[:, 1] if flip_y else points[:, 1]
+    return polygon
+
+def reserve(array, size):
+    # The array itself if it has room for size rows, else a copy at least twice as long.
+    if size <= len(array):
+        return array
+    grown = np.empty((max(size, 2 * len(array)),) + array.shape[1:], dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+class BranchHistory:
+    # Positions of a branch as rows of (x, y) in a preallocated buffer which
+    # doubles when full; points() hands out views of it.
+    def __init__(self, position, capacity=16):
+        self.data = np.empty((capacity, 2))
+        self.size = 0
+        self.append(position)
+
+    def append(self, position):
+        self.data = reserve(self.data, self.size + 1)
+        self.data[self.size] = position.real, position.imag
+        self.size += 1
+
+    def extend(self, points):
+        self.data = reserve(self.data, self.size + len(points))
+        self.data[self.size:self.size + len(points)] = points
+        self.size += len(points)
+
+    def points(self, start=0, stop=None):
+        stop = self.size if stop is None else min(stop, self.size)
+        return self.data[start:stop]
+
+    def __getitem__(self, index):
+        x, y = self.points()[index]
+        return complex(x, y)
+
+    def __len__(self):
+        return self.size
+
+def branch_pen(params, scale, generation, length):
+    gens = float(params["painter_generations"])
+    scale_factor = (scale - 1) * 3 + 1
+    pen_width = max(0, gens-generation) / gens * params["painter_thickness"] * scale_factor
+    if generation == 0 and length < 30:
+        intensity = 126/30.0 * length
+    else:
+        intensity = 17 + 99 * max(0, gens-generation) / gens
+    color = params["color"].darker(85 + (127 - intensity) * 4)
+    pen = QPen(color)
+    pen.setWidthF(pen_width)
+    return pen
+
+class TreeStyle:
+    # The pens of one tree, built once: one per generation, where all generations
+    # from painter_generations on look the same, plus one per length for the
+    # trunk while it fades in.
+    fade_length = 30
+
+    def __init__(self, params, scale):
+        generations = int(params["painter_generations"])
+        self.pens = [branch_pen(params, scale, generation, self.fade_length)
+                     for generation in range(max(0, generations) + 1)]
+        self.trunk_pens = [branch_pen(params, scale, 0, length) for length in range(self.fade_length)]
+
+    def pen(self, generation, length):
+        if generation == 0 and length < self.fade_length:
+            return self.trunk_pens[length]
+        return self.pens[min(generation, len(self.pens) - 1)]
+
+    def cutoff(self, pixel_size):
+        # The first generation too thin to draw at pixel_size, or None. Pens get
+        # thinner with every generation, so the ones after it are left out too,
+        # even the cosmetic ones which would float without their parents.
+        for generation, pen in enumerate(self.pens):
+            if too_thin(pen, pixel_size):
+                return generation
+        return None
+
+def simplify_polyline(points, tolerance):
+    # Ramer-Douglas-Peucker: keeps both ends and every point further than
+    # tolerance from the line through the points kept around it.
+    if len(points) < 3:
+        return points
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        direction = points[last] - points[first]
+        offsets = points[first + 1:last] - points[first]
+        length = np.hypot(direction[0], direction[1])
+        if length == 0:
+            distance = np.hypot(offsets[:, 0], offsets[:, 1])
+        else:
+            distance = np.abs(direction[0] * offsets[:, 1] - direction[1] * offsets[:, 0]) / length
+        index = np.argmax(distance)
+        if distance[index] > tolerance:
+            middle = first + 1 + index
+            keep[middle] = True
+            stack.append((first, middle))
+            stack.append((middle, last))
+    return points[keep]
+
+def lod_level(pixel_size):
+    # Zoom levels are powers of two of the scene units per pixel, so nearby zooms share a level.
+    return int(np.floor(np.log2(pixel_size)))
+
+def too_thin(pen, pixel_size):
+    # A pen of width 0 is cosmetic: Qt draws it one pixel wide at any zoom.
+    return pen.widthF() != 0 and round(pen.widthF() / pixel_size) == 0
+
+class PathBuckets:
+    # Keeps few path items per distinct pen in the scene; drawing more segments
+    # with the same pen extends that pen's newest item until it holds
+    # chunk_points points and then starts another one. Extending copies the
+    # path and flushing recomputes its geometry, so both stay bounded by the chunk.
+    def __init__(self, scene, chunk_points=4096):
+        self.scene = scene
+        self.chunk_points = chunk_points
+        self.paths = {}
+        self.sizes = {}
+        self.items = {}
+        self.dirty = set()
+
+    def add(self, pen, points):
+        if len(points) < 2:
+            return
+        key = (pen.color().rgba(), pen.widthF())
+        if key not in self.paths or self.sizes[key] >= self.chunk_points:
+            if key in self.dirty:
+                self.items[key][-1].setPath(self.paths[key])
+            self.paths[key] = QPainterPath()
+            self.sizes[key] = 0
+            self.items.setdefault(key, []).append(self.scene.addPath(QPainterPath(), pen))
+        self.paths[key].addPolygon(polygon_from_points(points))
+        self.sizes[key] += len(points)
+        self.dirty.add(key)
+
+    def flush(self):
+        for key in self.dirty:
+            self.items[key][-1].setPath(self.paths[key])
+        self.dirty.clear()
+
+    def remove(self):
+        for items in self.items.values():
+            for item in items:
+                self.scene.removeItem(item)
+        self.paths = {}
+        self.sizes = {}
+        self.items = {}
+        self.dirty.clear()
+
+    def __len__(self):
+        return sum(len(items) for items in self.items.values())
+
+class Stats:
+    # Opt-in instrumentation, pass one to Tree, GrassDrawer or the dialog.
+    # Wall time per stage, live and dead branches after every iteration,
+    # points handed to the scene and its item count.
+    def __init__(self):
+        self.seconds = {}
+        self.calls = {}
+        self.live_branches = []
+        self.dead_branches = []
+        self.points = 0
+        self.scene_items = 0
+
+    def add_time(self, stage, seconds):
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+        self.calls[stage] = self.calls.get(stage, 0) + 1
+
+    def add_iteration(self, live, dead):
+        self.live_branches.append(live)
+        self.dead_branches.append(dead)
+
+    def summary(self):
+        times = ", ".join("{0} {1:.0f} ms".format(stage, 1000 * seconds)
+                          for stage, seconds in sorted(self.seconds.items()))
+        live = self.live_branches[-1] if self.live_branches else 0
+        dead = self.dead_branches[-1] if self.dead_branches else 0
+        return "{0}; live {1}, dead {2}, points {3}, items {4}".format(times, live, dead, self.points,
+                                                                        self.scene_items)
+
+class SegmentBatch:
+    # Segments added to one tree by some growth steps, as parallel arrays:
+    # segment i runs from start[i] to end[i] and extends the branch with index
+    # branch[i], whose history holds length[i] points once end[i] is added.
+    def __init__(self, tree_id, start, end, generation, branch, length):
+        self.tree_id = tree_id
+        self.start = start
+        self.end = end
+        self.generation = generation
+        self.branch = branch
+        self.length = length
+
+    @classmethod
+    def empty(cls, tree_id=0):
+        return cls(tree_id, np.empty((0, 2)), np.empty((0, 2)),
+                   np.empty(0, dtype=int), np.empty(0, dtype=int), np.empty(0, dtype=int))
+
+    @classmethod
+    def concatenate(cls, tree_id, batches):
+        if not batches:
+            return cls.empty(tree_id)
+        if len(batches) == 1:
+            return batches[0]
+        return cls(tree_id, *[np.concatenate([getattr(batch, name) for batch in batches])
+                              for name in ("start", "end", "generation", "branch", "length")])
+
+    def __len__(self):
+        return len(self.branch)
+
+    def polylines(self):
+        # Joins the segments back into one polyline per run of consecutive
+        # points of a branch; yields (generation, length, points).
+        if len(self) == 0:
+            return
+        order = np.lexsort((self.length, self.branch))
+        branch = self.branch[order]
+        length = self.length[order]
+        breaks = np.flatnonzero((branch[1:] != branch[:-1]) | (length[1:] != length[:-1] + 1)) + 1
+        for run in np.split(order, breaks):
+            points = np.concatenate((self.start[run[:1]], self.end[run]))
+            yield self.generation[run[0]], self.length[run[-1]], points
+
 class Branch:
-    def __init__(self, position, velocity, params, generation=0):
+    def __init__(self, position, velocity, params, rng, generation=0, branch_after=None):
         self.params = params
+        self.rng = rng
         self.position = position
-        self.history = [position]
+        self.history = BranchHistory(position)
+        self.bounds = Box(position.real, position.real, position.imag, position.imag)
         self.velocity = velocity
         self.branches = []
-        self.branch_after = random.randint(*self.params["branch_after_range"])
+        if branch_after is None:
+            branch_after = self.rng.randint(*self.params["branch_after_range"])
+        self.branch_after = branch_after
         self.is_alive = True
         self.is_dying = False
         self.gravity = self.params["gravity"]
         self.generation = generation
-        self.already_drawn = None
+        self.already_drawn = 0
+        self.lod = None
+        self.index = None
         self.down_damping_x = self.params["down_damping_x"]
         self.down_damping_y = self.params["down_damping_y"]
     
@@ -76,153 +345,825 @@ class Branch:
         if pointing_down:
             self.velocity = complex(np.real(self.velocity) * self.down_damping_x,
                                     np.imag(self.velocity) * self.down_damping_y)
-            if random.randrange(1, self.params["down_die_probability"]) == 4:
+            if self.rng.randrange(1, self.params["down_die_probability"]) == 4:
                 self.is_dying = True
     
     def die_if_too_old(self):
-        if len(self.history) > 3 and random.randrange(8, 20) < self.generation:
+        if len(self.history) > 3 and self.rng.randrange(8, 20) < self.generation:
             self.is_alive = False
     
     def grow(self):
-        for subbranch in self.branches:
-            subbranch.grow()
-        
-        if np.imag(self.position) < random.randint(12, 40) and np.imag(self.velocity) < 0:
+        if np.imag(self.position) < self.rng.randint(12, 40) and np.imag(self.velocity) < 0:
             self.is_alive = False
             
         self.die_if_too_old()
         
         if not self.is_alive:
-            return
+            return []
         
         self.apply_gravity()
         
         self.position += self.velocity
         self.history.append(self.position)
+        self.bounds.grow_to_point(self.position)
 
         if len(self.history) > self.branch_after:
-            if self.params["keep_central"] < random.uniform(0, 1):
+            if self.params["keep_central"] < self.rng.uniform(0, 1):
                 self.is_alive = False
             if self.is_dying:
-                return
-            self.do_branch()
+                return []
+            return self.do_branch()
+        return []
 
     def do_branch(self, count=2):
-        v1 = self.velocity - self.params["branch_split"]*(1 + self.params["branch_split_var"] * random.random()-0.5)
-        v2 = self.velocity + self.params["branch_split"]*(1 + self.params["branch_split_var"] * random.random()-0.5)
-        v1 = v1 / np.abs(v1) * np.abs(self.velocity) * random.uniform(0.9, 1.1)
-        v2 = v2 / np.abs(v2) * np.abs(self.velocity) * random.uniform(0.9, 1.1)
-        self.branches.append(Branch(self.position, v1, self.params, self.generation + 1))
-        self.branches.append(Branch(self.position, v2, self.params, self.generation + 1))
-
-    def draw_into(self, scene, incremental=False):
-        for subbranch in self.branches:
-            subbranch.draw_into(scene, incremental)
-        start = self.already_drawn if incremental else None
-        points = [QPointF(np.real(x), -np.imag(x)) for x in self.history[start:]]
-
-        gens = float(self.params["painter_generations"])
-        scale_factor = (self.params["scale"] - 1) * 3 + 1
-        pen_width = max(0, gens-self.generation) / gens * self.params["painter_thickness"] * scale_factor
-        if self.generation == 0 and len(self.history) < 30:
-            intensity = 126/30.0 * len(self.history)
-        else:
-            intensity = 17 + 99 * max(0, gens-self.generation) / gens
-        color = self.params["color"].darker(85 + (127 - intensity) * 4)
-        outline = color.darker(500)
-        pen = QPen(color)
-        pen.setWidthF(pen_width)
-        darkPen = QPen(outline)
-        darkPen.setWidthF(pen_width)
-        depth = self.params["depth"]
-        path = QPainterPath()
-        path.moveTo(points[0])
-        for index in range(1, len(points) - 1):
-            path.lineTo(points[index])
-        scene.addPath(path, pen)
+        v1 = self.velocity - self.params["branch_split"]*(1 + self.params["branch_split_var"] * self.rng.random()-0.5)
+        v2 = self.velocity + self.params["branch_split"]*(1 + self.params["branch_split_var"] * self.rng.random()-0.5)
+        v1 = v1 / np.abs(v1) * np.abs(self.velocity) * self.rng.uniform(0.9, 1.1)
+        v2 = v2 / np.abs(v2) * np.abs(self.velocity) * self.rng.uniform(0.9, 1.1)
+        children = [Branch(self.position, v1, self.params, self.rng, self.generation + 1),
+                    Branch(self.position, v2, self.params, self.rng, self.generation + 1)]
+        self.branches.extend(children)
+        return children
 
+    def pen(self):
+        return self.params["style"].pen(self.generation, len(self.history))
+
+    def new_points(self, incremental=False):
+        start = self.already_drawn if incremental else 0
+        points = self.history.points(start, max(start + 1, len(self.history) - 1))
         if incremental:
             self.already_drawn = max(0, len(self.history) - 1)
+        return points
+
+    def draw_into(self, scene, incremental=False, buckets=None):
+        emitted = 0
+        for subbranch in self.branches:
+            emitted += subbranch.draw_into(scene, incremental, buckets)
+        pen = self.pen()
+        points = self.new_points(incremental)
+        if buckets is not None:
+            buckets.add(pen, points)
+        else:
+            path = QPainterPath()
+            path.addPolygon(polygon_from_points(points))
+            scene.addPath(path, pen)
+        return emitted + len(points)
+
+    def lod_points(self, pixel_size):
+        # Simplified history for a zoom level, cached until the branch grows again.
+        level = lod_level(pixel_size)
+        if self.lod is None:
+            self.lod = {}
+        length, points = self.lod.get(level, (None, None))
+        if length != len(self.history):
+            points = simplify_polyline(self.history.points(0, max(1, len(self.history) - 1)), 2.0 ** level)
+            self.lod[level] = (len(self.history), points)
+        return points
+
+    def draw_lod_into(self, buckets, pixel_size, cutoff=None):
+        # Branches of the cutoff generation and their subtrees are not drawn.
+        if cutoff is not None and self.generation >= cutoff:
+            return
+        for subbranch in self.branches:
+            subbranch.draw_lod_into(buckets, pixel_size, cutoff)
+        buckets.add(self.pen(), self.lod_points(pixel_size))
+
+    def walk(self):
+        for subbranch in self.branches:
+            for branch in subbranch.walk():
+                yield branch
+        yield self
+
+    def paint_into(self, painter):
+        for subbranch in self.branches:
+            subbranch.paint_into(painter)
+        painter.setPen(self.pen())
+        painter.drawPolyline(polygon_from_points(self.history.points(0, max(1, len(self.history) - 1))))
 
     def get_bounding_box(self):
-        if len(self.branches) == 0:
-            result = Box(
-                       min(map(np.real, self.history)),
-                       max(map(np.real, self.history)),
-                       min(map(np.imag, self.history)),
-                       max(map(np.imag, self.history))
-                     )
-            return result
-        children_bounds = [item.get_bounding_box() for item in self.branches]
-        own_bounds = Box(0, 0, 0, 0)
-        for box in children_bounds:
-            own_bounds.grow_to(box)
+        own_bounds = self.bounds.copy()
+        for subbranch in self.branches:
+            own_bounds.grow_to(subbranch.get_bounding_box())
         return own_bounds
 
+class VectorizedGrowth:
+    # Grows all live tips of a tree in one batched step. The tips are rows of
+    # arrays, and every point grown is appended to one arena of rows tagged with
+    # the index of its branch. Branch objects are only brought up to date when
+    # branch_objects() is called; growing does not touch them.
+    def __init__(self, branches, params, rng, bounds=None):
+        # branches are the Branch objects made so far, in index order.
+        self.params = params
+        self.rng = rng
+        self.bounds = bounds
+        self.segments = None
+        self.objects = list(branches)
+        self.branch_count = len(branches)
+        self.branch_generation = np.array([b.generation for b in branches], dtype=int)
+        self.parent = np.full(len(branches), -1, dtype=int)
+        self.first_row = np.zeros(len(branches), dtype=int)
+        lengths = [len(b.history) for b in branches]
+        self.first_row[1:] = np.cumsum(lengths)[:-1]
+        self.points = np.concatenate([b.history.points() for b in branches])
+        self.point_branch = np.repeat(np.arange(len(branches)), lengths)
+        self.size = len(self.points)
+        self.synced_rows = self.size
+        self.died = []
+
+        tips = [b for b in branches if b.is_alive]
+        self.position = np.array([b.position for b in tips], dtype=complex)
+        self.velocity = np.array([b.velocity for b in tips], dtype=complex)
+        self.generation = np.array([b.generation for b in tips], dtype=int)
+        self.index = np.array([b.index for b in tips], dtype=int)
+        self.branch_after = np.array([b.branch_after for b in tips], dtype=int)
+        self.length = np.array([len(b.history) for b in tips], dtype=int)
+        self.is_dying = np.array([b.is_dying for b in tips], dtype=bool)
+
+    def __len__(self):
+        return len(self.index)
+
+    def keep(self, mask):
+        self.died.append(self.index[~mask])
+        self.position = self.position[mask]
+        self.velocity = self.velocity[mask]
+        self.generation = self.generation[mask]
+        self.index = self.index[mask]
+        self.branch_after = self.branch_after[mask]
+        self.length = self.length[mask]
+        self.is_dying = self.is_dying[mask]
+
+    def add_points(self, position, index):
+        end = self.size + len(index)
+        self.points = reserve(self.points, end)
+        self.point_branch = reserve(self.point_branch, end)
+        self.points[self.size:end, 0] = position.real
+        self.points[self.size:end, 1] = position.imag
+        self.point_branch[self.size:end] = index
+        self.size = end
+
+    def apply_gravity(self):
+        velocity = self.velocity
+        weight = np.sin(np.arctan2(velocity.real, velocity.imag))
+        accel = self.params["gravity"] * np.abs(weight)
+        pointing_down = velocity.imag < 0
+        velocity = velocity - 1j * accel * np.where(pointing_down, 3, 1)
+        velocity[pointing_down] = velocity.real[pointing_down] * self.params["down_damping_x"] \
+                                  + 1j * velocity.imag[pointing_down] * self.params["down_damping_y"]
+        dies = self.rng.randint(1, self.params["down_die_probability"], len(self)) == 4
+        self.is_dying |= pointing_down & dies
+        self.velocity = velocity
+
+    def step(self):
+        # Returns the number of branches spawned. The segments grown are left
+        # in self.segments as (start, end, generation, index, length) arrays.
+        self.segments = None
+        if len(self) == 0:
+            return 0
+        count = len(self)
+        alive = ~((self.position.imag < self.rng.randint(12, 41, count)) & (self.velocity.imag < 0))
+        alive &= ~((self.length > 3) & (self.rng.randint(8, 20, count) < self.generation))
+        self.keep(alive)
+        if len(self) == 0:
+            return 0
+
+        self.apply_gravity()
+        start = self.position
+        self.position = self.position + self.velocity
+        self.length += 1
+        self.segments = (np.column_stack((start.real, start.imag)),
+                         np.column_stack((self.position.real, self.position.imag)),
+                         self.generation, self.index, self.length.copy())
+        if self.bounds is not None:
+            self.bounds.grow_to(Box(self.position.real.min(), self.position.real.max(),
+                                    self.position.imag.min(), self.position.imag.max()))
+        self.add_points(self.position, self.index)
+
+        count = len(self)
+        splitting = self.length > self.branch_after
+        keep_central = ~(splitting & (self.params["keep_central"] < self.rng.uniform(0, 1, count)))
+        spawning = np.flatnonzero(splitting & ~self.is_dying)
+        spawned = self.do_branch(spawning)
+        self.keep(np.concatenate((keep_central, np.ones(spawned, dtype=bool))))
+        return spawned
+
+    def do_branch(self, parents):
+        # Two children per parent tip, starting where the parent is now.
+        count = len(parents)
+        split = self.params["branch_split"]
+        split_var = self.params["branch_split_var"]
+        velocity = self.velocity[parents]
+        speed = np.abs(velocity)
+        v1 = velocity - split * (1 + split_var * self.rng.random_sample(count) - 0.5)
+        v2 = velocity + split * (1 + split_var * self.rng.random_sample(count) - 0.5)
+        v1 = v1 / np.abs(v1) * speed * self.rng.uniform(0.9, 1.1, count)
+        v2 = v2 / np.abs(v2) * speed * self.rng.uniform(0.9, 1.1, count)
+        low, high = self.params["branch_after_range"]
+        branch_after = self.rng.randint(low, high + 1, (count, 2))
+        if count == 0:
+            return 0
+
+        first = self.branch_count
+        index = np.arange(first, first + 2 * count)
+        parent = np.repeat(self.index[parents], 2)
+        generation = np.repeat(self.generation[parents] + 1, 2)
+        position = np.repeat(self.position[parents], 2)
+        self.branch_count += 2 * count
+        self.branch_generation = reserve(self.branch_generation, self.branch_count)
+        self.parent = reserve(self.parent, self.branch_count)
+        self.first_row = reserve(self.first_row, self.branch_count)
+        self.branch_generation[first:self.branch_count] = generation
+        self.parent[first:self.branch_count] = parent
+        self.first_row[first:self.branch_count] = np.arange(self.size, self.size + 2 * count)
+        self.add_points(position, index)
+
+        self.position = np.concatenate((self.position, position))
+        self.velocity = np.concatenate((self.velocity, np.column_stack((v1, v2)).ravel()))
+        self.generation = np.concatenate((self.generation, generation))
+        self.index = np.concatenate((self.index, index))
+        self.branch_after = np.concatenate((self.branch_after, branch_after.ravel()))
+        self.length = np.concatenate((self.length, np.ones(2 * count, dtype=int)))
+        self.is_dying = np.concatenate((self.is_dying, np.zeros(2 * count, dtype=bool)))
+        return 2 * count
+
+    def branch_objects(self):
+        # Brings the Branch objects up to date with the arena and returns them by
+        # index. New branches are views for drawing and walking: their velocity
+        # and branch_after are not kept, the growth state stays in the arrays.
+        rows = np.arange(self.synced_rows, self.size)
+        for index in range(len(self.objects), self.branch_count):
+            x, y = self.points[self.first_row[index]]
+            branch = Branch(complex(x, y), 0j, self.params, None, self.branch_generation[index], 0)
+            branch.index = index
+            self.objects[self.parent[index]].branches.append(branch)
+            self.objects.append(branch)
+        if len(rows) > 0:
+            branch_of_row = self.point_branch[rows]
+            rows = rows[rows != self.first_row[branch_of_row]]
+            order = np.argsort(self.point_branch[rows], kind="stable")
+            rows = rows[order]
+            indices, starts = np.unique(self.point_branch[rows], return_index=True)
+            for index, block in zip(indices, np.split(rows, starts[1:])):
+                branch = self.objects[index]
+                points = self.points[block]
+                branch.history.extend(points)
+                lower = points.min(axis=0)
+                upper = points.max(axis=0)
+                branch.bounds.grow_to(Box(lower[0], upper[0], lower[1], upper[1]))
+                branch.position = complex(*points[-1])
+        if self.died:
+            for index in np.concatenate(self.died):
+                self.objects[index].is_alive = False
+            self.died = []
+        self.synced_rows = self.size
+        return self.objects
+
+    def geometry(self):
+        # The arena sorted into one block of points per branch, in index order.
+        branch_of_row = self.point_branch[:self.size]
+        order = np.argsort(branch_of_row, kind="stable")
+        offsets = np.zeros(self.branch_count + 1, dtype=np.int64)
+        np.cumsum(np.bincount(branch_of_row, minlength=self.branch_count), out=offsets[1:])
+        return TreeGeometry(self.points[order], offsets, self.branch_generation[:self.branch_count].astype(np.int32),
+                            self.params["scale"])
+
+class TreeGeometry:
+    # The grown branches of a tree without the Branch objects: all histories
+    # packed into one points array, branch i owning points[offsets[i]:offsets[i + 1]].
+    def __init__(self, points, offsets, generations, scale=1.0):
+        self.points = points
+        self.offsets = offsets
+        self.generations = generations
+        self.scale = scale
+
+    @classmethod
+    def from_tree(cls, tree):
+        # The packed branches of the tree come first, then the live ones in walk() order.
+        # Vectorized trees are read straight from their arena.
+        if tree.engine is not None:
+            return tree.engine.geometry()
+        packed = tree.packed.geometry()
+        branches = list(tree.trunk.walk())
+        offsets = np.empty(len(packed) + len(branches) + 1, dtype=np.int64)
+        offsets[:len(packed) + 1] = packed.offsets
+        np.cumsum([len(branch.history) for branch in branches], out=offsets[len(packed) + 1:])
+        offsets[len(packed) + 1:] += packed.offsets[-1]
+        points = np.concatenate([packed.points] + [branch.history.points() for branch in branches])
+        generations = np.concatenate((packed.generations,
+                                      np.array([branch.generation for branch in branches], dtype=np.int32)))
+        return cls(points, offsets, generations, tree.trunk.params["scale"])
+
+    def __len__(self):
+        return len(self.generations)
+
+    def branch_points(self, index):
+        return self.points[self.offsets[index]:self.offsets[index + 1]]
+
+    def get_bounding_box(self):
+        lower = self.points.min(axis=0)
+        upper = self.points.max(axis=0)
+        return Box(lower[0], upper[0], lower[1], upper[1])
+
+    def branch_bounds(self):
+        # Rows of (xmin, xmax, ymin, ymax), one per branch.
+        starts = self.offsets[:-1]
+        lower = np.minimum.reduceat(self.points, starts, axis=0)
+        upper = np.maximum.reduceat(self.points, starts, axis=0)
+        return np.column_stack((lower[:, 0], upper[:, 0], lower[:, 1], upper[:, 1]))
+
+    def save(self, directory):
+        os.makedirs(directory)
+        np.save(os.path.join(directory, "points.npy"), self.points)
+        np.save(os.path.join(directory, "offsets.npy"), self.offsets)
+        np.save(os.path.join(directory, "generations.npy"), self.generations)
+        np.save(os.path.join(directory, "scale.npy"), np.array(self.scale))
+
+    @classmethod
+    def load(cls, directory, mmap_mode=None):
+        def load_array(name):
+            return np.load(os.path.join(directory, name + ".npy"), mmap_mode=mmap_mode)
+        return cls(load_array("points"), load_array("offsets"), load_array("generations"), float(load_array("scale")))
+
+    def lines(self, style, pixel_size=None, branches=None):
+        # Yields (generation, pen, points) as drawn, simplified for pixel_size if given.
+        cutoff = style.cutoff(pixel_size) if pixel_size is not None else None
+        for index in range(len(self)) if branches is None else branches:
+            if cutoff is not None and self.generations[index] >= cutoff:
+                continue
+            points = self.branch_points(index)
+            pen = style.pen(self.generations[index], len(points))
+            points = points[:max(1, len(points) - 1)]
+            if pixel_size is not None:
+                points = simplify_polyline(points, 2.0 ** lod_level(pixel_size))
+            yield self.generations[index], pen, points
+
+    def paint(self, painter, params, pixel_size=None, branches=None):
+        for generation, pen, points in self.lines(TreeStyle(params, self.scale), pixel_size, branches):
+            painter.setPen(pen)
+            painter.drawPolyline(polygon_from_points(points))
+
+class PackedBranches:
+    # Finished branches of a growing tree, copied out of their Branch objects
+    # into buffers which double when full; geometry() is a read-only view.
+    def __init__(self, scale=1.0):
+        self.scale = scale
+        self.points = np.empty((0, 2))
+        self.size = 0
+        self.offsets = [0]
+        self.generations = []
+
+    def append(self, branch):
+        points = branch.history.points()
+        end = self.size + len(points)
+        self.points = reserve(self.points, end)
+        self.points[self.size:end] = points
+        self.size = end
+        self.offsets.append(end)
+        self.generations.append(branch.generation)
+
+    def __len__(self):
+        return len(self.generations)
+
+    def geometry(self):
+        points = self.points[:self.size]
+        points.flags.writeable = False
+        return TreeGeometry(points, np.array(self.offsets, dtype=np.int64),
+                            np.array(self.generations, dtype=np.int32), self.scale)
+
 class GrassDrawer:
-    def __init__(self, view):
-        self.view = view
-        self.bounds = self.view.scene().itemsBoundingRect()
-
-    def draw_some_grass(self, bundles=100):
-        for i in range(bundles):
-            width = abs(self.bounds.bottomLeft().x() - self.bounds.bottomRight().x())
-            x = random.gauss((self.bounds.bottomLeft().x() + self.bounds.bottomRight().x()) / 2.0, width / 4.5)
-            x = max(x, self.bounds.bottomLeft().x() - 1.2*width)
-            x = min(x, self.bounds.bottomRight().x() + 1.2*width)
-            max_z = 0.35 * (self.bounds.topLeft().y() - self.bounds.bottomLeft().y())
-            z = - (random.uniform(0, 1) ** 1.5 - 0.5 + random.uniform(-0.35, 0.35)) * max_z
-            size = 0.25 + ((max_z - z) / max_z) ** 1.5 + random.uniform(-0.1, 0.1)
-            y = z
-            opacity = ((max_z - (z+0.5*max_z)) / max_z) ** 2
-            self.draw_grass_bundle(location=(x, y), size=size, items=random.randint(6, 14), opacity=opacity)
-            if i % 25 == 0:
-                QApplication.processEvents()
-
-    def draw_grass_bundle(self, location, size, items, opacity):
+    def __init__(self, scene, rng, bounds=None, stats=None):
+        self.scene = scene
+        self.rng = rng
+        self.bounds = bounds if bounds is not None else scene.itemsBoundingRect()
+        self.stats = stats
+
+    def grass_blades(self, bundles=100, items=(6, 14), segments=5, exponent=2.0):
+        # Returns every blade of all bundles as a polyline in scene coordinates,
+        # shape (blades, segments + 1, 2), and the alpha each blade is drawn with.
+        rng = np.random.RandomState(self.rng.getrandbits(32))
+        left, right = self.bounds.left(), self.bounds.right()
+        width = abs(right - left)
+        x = rng.normal((left + right) / 2.0, width / 4.5, bundles)
+        x = np.clip(x, left - 1.2*width, right + 1.2*width)
+        max_z = 0.35 * (self.bounds.top() - self.bounds.bottom())
+        z = - (rng.uniform(0, 1, bundles) ** 1.5 - 0.5 + rng.uniform(-0.35, 0.35, bundles)) * max_z
+        size = 0.25 + ((max_z - z) / max_z) ** 1.5 + rng.uniform(-0.1, 0.1, bundles)
+        opacity = ((max_z - (z+0.5*max_z)) / max_z) ** 2
+
+        bundle = np.repeat(np.arange(bundles), rng.randint(items[0], items[1] + 1, bundles))
         baseSize = 8
-        size = size * baseSize
         baseHeight = 0.4
-        pen = QPen(QColor(180, 180, 180, opacity * 80 + 15))
-        for i in range(items):
-            segments = 5
-            exponent = 2.0
-            base = QPoint(*location)
-            x_diff = size * baseSize * random.uniform(-0.25, 0.25)
-            y_diff = size * baseSize * random.uniform(0.8, 1.2) * baseHeight
-            current_location = base
-            for segment_index in range(segments):
-                segment_tip = QPoint(location[0] + x_diff / segments ** exponent * (segment_index + 1) ** exponent,
-                                     location[1] - y_diff / segments * segment_index)
-                self.view.scene().addLine(QLineF(current_location, segment_tip), pen).setZValue(np.imag(location[0]))
-                current_location = segment_tip
+        size = size[bundle] * baseSize
+        x_diff = size * baseSize * rng.uniform(-0.25, 0.25, len(bundle))
+        y_diff = size * baseSize * rng.uniform(0.8, 1.2, len(bundle)) * baseHeight
+        segment_index = np.arange(segments)
+        blades = np.empty((len(bundle), segments + 1, 2))
+        blades[:, 0, 0] = x[bundle]
+        blades[:, 0, 1] = z[bundle]
+        blades[:, 1:, 0] = x[bundle, None] + x_diff[:, None] / segments ** exponent * (segment_index + 1) ** exponent
+        blades[:, 1:, 1] = z[bundle, None] - y_diff[:, None] / segments * segment_index
+        return blades, opacity[bundle] * 80 + 15
+
+    def draw_some_grass(self, bundles=100, alpha_step=10):
+        start = time.time() if self.stats is not None else None
+        blades, alpha = self.grass_blades(bundles)
+        alpha = (np.round(alpha / alpha_step) * alpha_step).astype(int)
+        levels = np.unique(alpha)
+        for level in levels:
+            path = QPainterPath()
+            for blade in blades[alpha == level]:
+                path.addPolygon(polygon_from_points(blade, flip_y=False))
+            self.scene.addPath(path, QPen(QColor(180, 180, 180, min(255, int(level)))))
+        if self.stats is not None:
+            self.stats.add_time("grass", time.time() - start)
+            self.stats.points += blades.shape[0] * blades.shape[1]
 
 class Tree:
-    def __init__(self, params, base_location=10, scale=1.0):
+    def __init__(self, params, base_location=10, scale=1.0, vectorized=False, stats=None, compact_every=0):
+        # With compact_every, every that many iterations finished branches are
+        # moved into self.packed and their objects dropped, see compact().
         params["scale"] = scale
         params["color"].darker(1/scale * 50)
         params["depth"] = np.imag(base_location)
-        self.trunk = Branch(base_location, params["v_start"] * scale, params)
+        params["style"] = TreeStyle(params, scale)
+        self.rng = random.Random(params.get("seed"))
+        self.root = Branch(base_location, params["v_start"] * scale, params, self.rng)
         start = params["start_branches"]
         if start > 1:
-            self.trunk.is_alive = False
-            for i in range(start / 2):
-                self.trunk.do_branch()
+            self.root.is_alive = False
+            for i in range(start // 2):
+                self.root.do_branch()
             if start % 2 == 1:
-                self.trunk.branches[0].is_alive = False
-                self.trunk.do_branch()
+                self.root.branches[0].is_alive = False
+                self.root.do_branch()
+        self.bounds = self.root.bounds.copy()
+        for index, branch in enumerate([self.root] + self.root.branches):
+            branch.index = index
+        self.frontier = [branch for branch in [self.root] + self.root.branches if branch.is_alive]
+        self.frontier_sizes = []
+        self.branch_count = 1 + len(self.root.branches)
+        self.stats = stats
+        self.buckets = None
+        self.lod_drawn = None
+        self.packed_lod = {}
+        self.tree_id = 0
+        self.segments = None
+        self.packed = PackedBranches(scale)
+        self.compact_every = compact_every
+        self.engine = None
+        if vectorized:
+            tip_rng = np.random.RandomState(self.rng.getrandbits(32))
+            self.engine = VectorizedGrowth([self.root] + self.root.branches, params, tip_rng, self.bounds)
+            self.frontier = None
+
+    @property
+    def trunk(self):
+        # With the vectorized engine, the Branch objects are brought up to date first.
+        if self.engine is not None:
+            self.engine.branch_objects()
+        return self.root
+
+    def live_count(self):
+        return len(self.frontier) if self.engine is None else len(self.engine)
 
-    def grow_iterations(self, steps=20, yield_every=0):
+    def grow(self):
+        iteration = len(self.frontier_sizes)
+        if self.compact_every != 0 and iteration > 0 and iteration % self.compact_every == 0:
+            self.compact()
+        if self.engine is not None:
+            self.branch_count += self.engine.step()
+            if self.segments is not None and self.engine.segments is not None:
+                self.segments.append(SegmentBatch(self.tree_id, *self.engine.segments))
+        else:
+            frontier = []
+            grown = [] if self.segments is not None else None
+            for branch in self.frontier:
+                length = len(branch.history)
+                children = branch.grow()
+                self.bounds.grow_to(branch.bounds)
+                if grown is not None and len(branch.history) > length:
+                    grown.append(branch)
+                if branch.is_alive:
+                    frontier.append(branch)
+                for child in children:
+                    child.index = self.branch_count
+                    self.branch_count += 1
+                frontier.extend(children)
+            self.frontier = frontier
+            if grown:
+                self.segments.append(self.grown_segments(grown))
+        self.frontier_sizes.append(self.live_count())
+
+    def grown_segments(self, grown):
+        # The last segment of every branch in grown.
+        length = np.array([len(branch.history) for branch in grown])
+        ends = np.array([branch.history.data[size - 2:size] for branch, size in zip(grown, length)])
+        return SegmentBatch(self.tree_id, ends[:, 0], ends[:, 1],
+                            np.array([branch.generation for branch in grown]),
+                            np.array([branch.index for branch in grown]), length)
+
+    def timed_grow(self):
+        start = time.time()
+        self.grow()
+        self.stats.add_time("grow", time.time() - start)
+        self.stats.add_iteration(self.live_count(), self.branch_count - self.live_count())
+
+    def grow_iterations(self, steps=20, yield_every=0, frame_time=None, cancelled=None):
+        # With a frame_time (in seconds), yields whenever that much time was spent
+        # growing since the last yield, instead of every yield_every iterations.
+        # Stops early once the cancelled callable, checked every iteration, returns True.
+        last_frame = time.time()
+        grow = self.grow if self.stats is None else self.timed_grow
         for iteration in range(steps):
-            self.trunk.grow()
-            if yield_every != 0 and iteration % yield_every == 0:
+            if cancelled is not None and cancelled():
+                return
+            grow()
+            if frame_time is not None:
+                if time.time() - last_frame >= frame_time:
+                    yield
+                    last_frame = time.time()
+            elif yield_every != 0 and iteration % yield_every == 0:
                 yield
 
-    def draw(self, scene, incremental=False):
-        self.trunk.draw_into(scene, incremental)
+    def compact(self):
+        # Packs every dead branch whose children are packed already and whose
+        # points were drawn incrementally or handed out as segments. The trunk stays.
+        # The arena of the vectorized engine is a packed form already.
+        if self.engine is not None:
+            return
+        self.pack_children(self.trunk)
+
+    def pack_children(self, branch):
+        # The boxes of packed children are folded into branch.bounds, so that
+        # get_bounding_box() of what is left still covers them.
+        remaining = []
+        for child in branch.branches:
+            if self.pack_finished(child):
+                branch.bounds.grow_to(child.bounds)
+            else:
+                remaining.append(child)
+        branch.branches = remaining
+
+    def pack_finished(self, branch):
+        self.pack_children(branch)
+        if branch.is_alive or branch.branches:
+            return False
+        if self.segments is None and branch.already_drawn < len(branch.history) - 1:
+            return False
+        self.packed.append(branch)
+        return True
+
+    def record_segments(self, tree_id=0):
+        # From now on grow() keeps the segments it adds until take_segments().
+        self.tree_id = tree_id
+        self.segments = []
+
+    def take_segments(self):
+        batch = SegmentBatch.concatenate(self.tree_id, self.segments)
+        self.segments = []
+        return batch
+
+    def grow_segments(self, steps=20, tree_id=0):
+        # Like grow_iterations(), but yields a SegmentBatch of what every step added.
+        self.record_segments(tree_id)
+        grow = self.grow if self.stats is None else self.timed_grow
+        for iteration in range(steps):
+            grow()
+            yield self.take_segments()
+
+    def get_bounding_box(self):
+        return self.bounds.copy()
+
+    def draw(self, scene, incremental=False, batched=False):
+        start = time.time() if self.stats is not None else None
+        self.lod_drawn = None
+        if not batched:
+            emitted = self.trunk.draw_into(scene, incremental)
+            if not incremental:
+                emitted += self.draw_packed(scene)
+        else:
+            if not incremental or self.buckets is None or self.buckets.scene is not scene:
+                self.buckets = PathBuckets(scene)
+            emitted = self.trunk.draw_into(scene, incremental, self.buckets)
+            if not incremental:
+                emitted += self.draw_packed(scene, self.buckets)
+            self.buckets.flush()
+        if self.stats is not None:
+            self.stats.add_time("draw", time.time() - start)
+            self.stats.points += emitted
+
+    def draw_lod(self, scene, pixel_size):
+        # Replaces what this tree drew in batched mode by a simplified version
+        # for pixel_size scene units per pixel. Nothing is sent to the scene again
+        # if the tree has not grown or been restyled since it was drawn for this zoom level.
+        cutoff = self.trunk.params["style"].cutoff(pixel_size)
+        drawn = (len(self.frontier_sizes), lod_level(pixel_size), cutoff)
+        if self.buckets is not None and self.buckets.scene is scene:
+            if self.lod_drawn == drawn:
+                return
+            self.buckets.remove()
+        self.buckets = PathBuckets(scene)
+        self.trunk.draw_lod_into(self.buckets, pixel_size, cutoff)
+        self.draw_packed(scene, self.buckets, pixel_size)
+        self.buckets.flush()
+        self.lod_drawn = drawn
+
+    def packed_lines(self, pixel_size=None):
+        # The drawn lines of the packed branches; simplified ones are cached per
+        # zoom level until more branches are packed or the tree is restyled.
+        style = self.trunk.params["style"]
+        if pixel_size is None:
+            return self.packed.geometry().lines(style)
+        key = (lod_level(pixel_size), style.cutoff(pixel_size))
+        count, lines = self.packed_lod.get(key, (None, None))
+        if count != len(self.packed):
+            lines = list(self.packed.geometry().lines(style, pixel_size))
+            self.packed_lod[key] = (len(self.packed), lines)
+        return lines
+
+    def draw_packed(self, scene, buckets=None, pixel_size=None):
+        # Packed branches were drawn before they were packed, so only full redraws need them.
+        emitted = 0
+        for generation, pen, points in self.packed_lines(pixel_size):
+            if buckets is not None:
+                buckets.add(pen, points)
+            else:
+                path = QPainterPath()
+                path.addPolygon(polygon_from_points(points))
+                scene.addPath(path, pen)
+            emitted += len(points)
+        return emitted
+
+    def restyle(self, values):
+        # Takes the drawing values over; redraw the tree to see them.
+        restyle_params(self.trunk.params, values)
+        self.lod_drawn = None
+        self.packed_lod = {}
+
+    def paint(self, painter):
+        self.trunk.paint_into(painter)
+        for generation, pen, points in self.packed.geometry().lines(self.trunk.params["style"]):
+            painter.setPen(pen)
+            painter.drawPolyline(polygon_from_points(points))
+
+# Widget values of the dialog (see treedialog.ui) which make_params() turns into params.
+default_values = {
+    "branch_split": 0.35,
+    "branch_after_min": 12,
+    "branch_after_max": 28,
+    "branch_split_var": 2.7,
+    "gravity": 0.0375,
+    "generations": 150,
+    "r": 1.0,
+    "g": 1.0,
+    "b": 1.0,
+    "color_speed": 0.5,
+    "down_damping_x": 0.95,
+    "down_damping_y": 0.97,
+    "v_start_x": 0.15,
+    "v_start_y": 1.6,
+    "v_start_var": 0.2,
+    "down_die_probability": 25,
+    "start_branches": 1,
+    "keep_central": 0.05,
+    "painter_thickness": 2.5,
+    "painter_generations": 7,
+    "tree_count": 4,
+}
+
+# Values that only change the pens, not the grown branches.
+drawing_values = ["r", "g", "b", "color_speed", "painter_thickness", "painter_generations"]
+
+def set_drawing_params(params, values):
+    params["color"] = QColor(values["r"] * 255, values["g"] * 255, values["b"] * 255)
+    params["color_speed"] = values["color_speed"]
+    params["painter_thickness"] = values["painter_thickness"]
+    params["painter_generations"] = values["painter_generations"]
+
+def restyle_params(params, values):
+    # Takes the drawing values over into the params of a grown tree.
+    set_drawing_params(params, values)
+    params["style"] = TreeStyle(params, params["scale"])
+
+def make_params(values, rng):
+    params = dict()
+    params["branch_split"] = values["branch_split"]
+    params["branch_after_range"] = (values["branch_after_min"], values["branch_after_max"])
+    params["branch_split_var"] = values["branch_split_var"]
+    params["gravity"] = values["gravity"]
+    params["down_die_probability"] = values["down_die_probability"]
+    params["down_damping_x"] = values["down_damping_x"]
+    params["down_damping_y"] = values["down_damping_x"]
+    params["start_branches"] = values["start_branches"]
+    params["keep_central"] = values["keep_central"]
+    set_drawing_params(params, values)
+    start_rand = [rng.uniform(-1, 1) * values["v_start_var"] for i in range(2)]
+    params["v_start"] = complex(values["v_start_x"]+start_rand[0], values["v_start_y"]+start_rand[1])
+    params["seed"] = rng.getrandbits(32)
+    return params
+
+def plan_forest(tree_count, rng, need_spacing=65, z_range=80, width=None):
+    # Base locations at least need_spacing apart along x, in a band of the given
+    # width which by default widens with the tree count. Sorted offsets into the
+    # width left after reserving the spacing, plus i * need_spacing, are spread
+    # uniformly over all valid layouts; the trees are then put in random order.
+    if width is None:
+        width = max(700, 1.5 * need_spacing * tree_count)
+    free = width - need_spacing * (tree_count - 1)
+    if free < 0:
+        raise ValueError("{0} trees {1} apart do not fit into a width of {2}".format(
+            tree_count, need_spacing, width))
+    left = 10 + 150*tree_count - width / 2.0
+    offsets = sorted(rng.uniform(0, free) for tree_index in range(tree_count))
+    xs = [left + offset + i * need_spacing for i, offset in enumerate(offsets)]
+    rng.shuffle(xs)
+    layout = []
+    for x in xs:
+        base_z = rng.uniform(-z_range, z_range)
+        scale = 1.0 + 0.75 * ((z_range - base_z) / (2.0*z_range)) ** 2
+        layout.append((complex(x, base_z), scale))
+    return layout
+
+class GrowthWorker(QThread):
+    # Grows a forest off the GUI thread. Every frame put into the bounded queue
+    # holds the params, a SegmentBatch and the bounds so far of one tree; None
+    # marks the end of the forest.
+    # With every == 0, a frame is produced after each frame_time of growing.
+    # Branches handed out in finished frames are packed every compact_every iterations.
+    frame_time = 1 / 60.0
+    compact_every = 25
+
+    def __init__(self, values, layout, rng, every, frames, stats=None):
+        QThread.__init__(self)
+        self.values = values
+        self.layout = layout
+        self.rng = rng
+        self.every = every
+        self.frames = frames
+        self.stats = stats
+        self.cancelled = False
+        self.trees = []
+
+    def cancel(self):
+        self.cancelled = True
+
+    def is_cancelled(self):
+        return self.cancelled
+
+    def put(self, frame):
+        while not self.cancelled:
+            try:
+                self.frames.put(frame, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def run(self):
+        frame_time = self.frame_time if self.every == 0 else None
+        for tree_index, (base_location, scale) in enumerate(self.layout):
+            params = make_params(self.values, self.rng)
+            tree = Tree(params, base_location=base_location, scale=scale, stats=self.stats,
+                        compact_every=self.compact_every)
+            tree.record_segments(tree_index)
+            self.trees.append(tree)
+            for iteration in tree.grow_iterations(self.values["generations"], self.every, frame_time,
+                                                  self.is_cancelled):
+                if not self.put((params, tree.take_segments(), tree.get_bounding_box())):
+                    return
+            if self.cancelled or not self.put((params, tree.take_segments(), tree.get_bounding_box())):
+                return
+        self.put(None)
+
+class PreviewWorker(GrowthWorker):
+    # Grows the whole forest to a fraction of its generations, puts a list of
+    # (params, TreeGeometry) for a coarse look, then grows on and puts None.
+    coarse_fraction = 0.5
+
+    def __init__(self, values, layout, rng, frames):
+        GrowthWorker.__init__(self, values, layout, rng, 0, frames)
+
+    def grow_to(self, generations):
+        for tree in self.trees:
+            for iteration in range(generations - len(tree.frontier_sizes)):
+                if self.cancelled:
+                    return False
+                tree.grow()
+        return True
+
+    def run(self):
+        for base_location, scale in self.layout:
+            params = make_params(self.values, self.rng)
+            self.trees.append(Tree(params, base_location=base_location, scale=scale))
+        generations = self.values["generations"]
+        if not self.grow_to(int(generations * self.coarse_fraction)):
+            return
+        if not self.put([(tree.trunk.params, TreeGeometry.from_tree(tree)) for tree in self.trees]):
+            return
+        if self.grow_to(generations):
+            self.put(None)
 
 class TreeDialog(QDialog):
-    def __init__(self):
+    def __init__(self, profile=False):
         import treedialog
         QDialog.__init__(self)
         self.ui = treedialog.Ui_Dialog()
@@ -231,76 +1172,251 @@ class TreeDialog(QDialog):
         self.scene = QGraphicsScene()
         self.ui.image.setScene(self.scene)
         self.ui.image.setRenderHints(QPainter.HighQualityAntialiasing)
+        self.seeds = random.Random()
+        self.profile = profile
+        self.stats = None
+        self.worker = None
+        self.trees = []
+        self.fit_rect = None
+        self.scene_bounds = None
+        self.values = None
+        self.seed = None
+        self.preview_frame = None
+        self.restyled = set()
+        self.timer = QTimer(self)
+        self.timer.setInterval(16)
+        self.timer.timeout.connect(self.show_frames)
+        self.preview_timer = QTimer(self)
+        self.preview_timer.setInterval(16)
+        self.preview_timer.timeout.connect(self.show_preview)
+        # Live preview waits until the widgets were left alone for a moment.
+        self.debounce = QTimer(self)
+        self.debounce.setSingleShot(True)
+        self.debounce.setInterval(300)
+        self.debounce.timeout.connect(self.preview)
+        for name in default_values:
+            getattr(self.ui, name).valueChanged.connect(self.schedule_preview)
+        self.ui.live_preview.toggled.connect(self.preview_toggled)
 
-    def get_params(self):
-        params = dict()
-        params["branch_split"] = self.ui.branch_split.value()
-        params["branch_after_range"] = (self.ui.branch_after_min.value(), self.ui.branch_after_max.value())
-        params["branch_split_var"] = self.ui.branch_split_var.value()
-        params["gravity"] = self.ui.gravity.value()
-        params["down_die_probability"] = self.ui.down_die_probability.value()
-        params["down_damping_x"] = self.ui.down_damping_x.value()
-        params["down_damping_y"] = self.ui.down_damping_x.value()
-        params["start_branches"] = self.ui.start_branches.value()
-        params["keep_central"] = self.ui.keep_central.value()
-        params["color"] = QColor(self.ui.r.value() * 255, self.ui.g.value() * 255, self.ui.b.value() * 255)
-        params["color_speed"] = self.ui.color_speed.value()
-        params["painter_thickness"] = self.ui.painter_thickness.value()
-        params["painter_generations"] = self.ui.painter_generations.value()
-        start_rand = [random.uniform(-1, 1) * self.ui.v_start_var.value() for i in range(2)]
-        params["v_start"] = complex(self.ui.v_start_x.value()+start_rand[0], self.ui.v_start_y.value()+start_rand[1])
-        return params
+    def get_values(self):
+        return dict((name, getattr(self.ui, name).value()) for name in default_values)
+
+    def get_params(self, rng):
+        return make_params(self.get_values(), rng)
+
+    def cancel_anim(self):
+        self.timer.stop()
+        self.preview_timer.stop()
+        if self.worker is not None:
+            self.worker.cancel()
+            self.worker.wait()
+            self.worker = None
 
     def new_anim(self):
-        image = None
-        painter_id = random.randint(0, 2**32)
-        self.active_painer = painter_id
-        index = 0
-        every = self.ui.repaint.value()
+        self.start_growth(self.get_values(), self.seeds.getrandbits(32))
 
+    def start_growth(self, values, seed, preview=False):
+        self.cancel_anim()
         self.scene.clear()
+        self.trees = []
+        self.fit_rect = None
+        self.scene_bounds = None
+        self.values = values
+        self.seed = seed
+        self.index = 0
+        self.buckets = {}
+        self.preview_frame = None
+        self.restyled = set()
+        self.stats = Stats() if self.profile else None
+        rng = random.Random(self.seed)
+        try:
+            layout = plan_forest(self.values["tree_count"], rng)
+        except ValueError as error:
+            self.show_progress("Cannot place the trees: {0}".format(error))
+            return
+        if preview:
+            self.frames = queue.Queue(maxsize=1)
+            self.worker = PreviewWorker(self.values, layout, rng, self.frames)
+            self.worker.start()
+            self.preview_timer.start()
+        else:
+            self.frames = queue.Queue(maxsize=8)
+            self.worker = GrowthWorker(self.values, layout, rng, self.ui.repaint.value(), self.frames, self.stats)
+            self.worker.start()
+            self.timer.start()
 
-        tree_count = self.ui.tree_count.value()
-        need_spacing = 65
-        used_locations = []
-        for tree_index in range(tree_count):
-            z_range = 80
-            base_z = random.uniform(-z_range, z_range)
-
-            def make_base():
-                return complex(10 + random.uniform(-350 + 150*tree_count, 350 + 150*tree_count), base_z)
-            def closest_distance_to_used(base):
-                return min([np.abs(np.real(base - item)) for item in used_locations])
-            base_location = make_base()
-            while not len(used_locations) == 0 and closest_distance_to_used(base_location) < need_spacing:
-                base_location = make_base()
-
-            used_locations.append(base_location)
-            scale = 1.0 + 0.75 * ((z_range - base_z) / (2*z_range)) ** 2
-            self.tree = Tree(self.get_params(), base_location=base_location, scale=scale)
-            for iteration in self.tree.grow_iterations(self.ui.generations.value(), yield_every=every):
-                self.tree.draw(self.scene, incremental=True)
-                self.ui.progress.setText("Working ... displayed frame: {0}".format(index))
-
-                gradient = QLinearGradient(self.scene.itemsBoundingRect().topLeft(),
-                                           self.scene.itemsBoundingRect().bottomLeft())
-                gradient.setColorAt(0.4, QColor(0, 0, 0))
-                gradient.setColorAt(0, QColor(25, 25, 25))
-                self.scene.setBackgroundBrush(QBrush(gradient))
-
-                self.ui.image.repaint()
-                QApplication.processEvents()
-                index += every
-                if self.active_painer != painter_id:
-                    return
+    def changed_values(self, values):
+        return [name for name in default_values if self.values is None or values[name] != self.values[name]]
+
+    def schedule_preview(self, value=None):
+        # A growth value makes whatever is growing stale, the preview restarts once
+        # the widgets settle. Drawing values keep the worker, preview() restyles.
+        if self.ui.live_preview.isChecked():
+            changed = self.changed_values(self.get_values())
+            if self.worker is not None and not all(name in drawing_values for name in changed):
+                self.cancel_anim()
+            self.debounce.start()
+
+    def preview_toggled(self, checked):
+        if checked:
+            self.debounce.start()
+        else:
+            self.debounce.stop()
+
+    def preview(self):
+        values = self.get_values()
+        changed = self.changed_values(values)
+        if not changed and (self.worker is not None or self.trees):
+            return
+        if (self.worker is not None or self.trees) and all(name in drawing_values for name in changed):
+            if self.worker is not None:
+                self.restyle_growing(values)
+            else:
+                self.restyle(values)
+            return
+        seed = self.seed if self.seed is not None else self.seeds.getrandbits(32)
+        self.start_growth(values, seed, preview=True)
+
+    def restyle(self, values):
+        # Only the pens changed: the grown trees are drawn again.
+        self.values = values
+        for tree in self.trees:
+            tree.restyle(values)
+        self.fit_and_draw_lod()
+
+    def restyle_growing(self, values):
+        # Only the pens changed while the worker grows on: frames still to come
+        # are drawn with them, the coarse preview at once and the rest once finished.
+        self.values = values
+        self.restyled = set()
+        if self.preview_frame is not None:
+            self.draw_preview(self.preview_frame)
+
+    def frame_params(self, params):
+        # The params of a frame with the dialog's drawing values, which may be
+        # newer than the ones the worker started with.
+        if self.values is not self.worker.values and id(params) not in self.restyled:
+            restyle_params(params, self.values)
+            self.restyled.add(id(params))
+        return params
+
+    def show_preview(self):
+        try:
+            frame = self.frames.get_nowait()
+        except queue.Empty:
+            return
+        if frame is None:
+            for tree in self.worker.trees:
+                self.grow_scene_bounds(tree.get_bounding_box())
+            self.update_background()
+            self.finish_anim()
+            return
+        for params, geometry in frame:
+            self.grow_scene_bounds(geometry.get_bounding_box())
+        self.update_background()
+        self.ui.image.fitInView(self.scene_bounds.scene_rect(), 1)
+        self.preview_frame = frame
+        self.draw_preview(frame)
+        self.show_progress("Preview ...")
+
+    def draw_preview(self, frame):
+        # Coarse first: simplified to a few pixels until the full trees are grown.
+        for buckets in self.buckets.values():
+            buckets.remove()
+        self.buckets = {}
+        pixel_size = 4.0 / self.ui.image.transform().m11()
+        for tree_index, (params, geometry) in enumerate(frame):
+            buckets = self.buckets[tree_index] = PathBuckets(self.scene)
+            for generation, pen, points in geometry.lines(self.frame_params(params)["style"], pixel_size):
+                buckets.add(pen, points)
+            buckets.flush()
+
+    def grow_scene_bounds(self, bounds):
+        # Returns whether the scene bounds grew.
+        if self.scene_bounds is None:
+            self.scene_bounds = bounds
+        elif not self.scene_bounds.contains(bounds):
+            self.scene_bounds.grow_to(bounds)
+        else:
+            return False
+        return True
+
+    def show_frames(self):
+        start = time.time() if self.stats is not None else None
+        shown = False
+        grown = False
+        for count in range(self.frames.maxsize):
+            try:
+                frame = self.frames.get_nowait()
+            except queue.Empty:
+                break
+            if frame is None:
+                self.finish_anim()
+                return
+            params, batch, bounds = frame
+            params = self.frame_params(params)
+            if self.grow_scene_bounds(bounds):
+                grown = True
+            if batch.tree_id not in self.buckets:
+                self.buckets[batch.tree_id] = PathBuckets(self.scene)
+            buckets = self.buckets[batch.tree_id]
+            for generation, length, points in batch.polylines():
+                buckets.add(params["style"].pen(generation, length), points)
+            buckets.flush()
+            if self.stats is not None:
+                self.stats.points += len(batch)
+            self.index += 1
+            shown = True
+        if not shown:
+            return
+
+        if grown:
+            self.update_background()
+        if self.stats is not None:
+            self.stats.add_time("frame", time.time() - start)
+        self.show_progress("Working ... displayed frame: {0}".format(self.index))
+
+    def update_background(self):
+        rect = self.scene_bounds.scene_rect()
+        gradient = QLinearGradient(rect.topLeft(), rect.bottomLeft())
+        gradient.setColorAt(0.4, QColor(0, 0, 0))
+        gradient.setColorAt(0, QColor(25, 25, 25))
+        self.scene.setBackgroundBrush(QBrush(gradient))
+
+    def show_progress(self, text):
+        if self.stats is not None:
+            self.stats.scene_items = len(self.scene.items())
+            text += " | " + self.stats.summary()
+        self.ui.progress.setText(text)
+
+    def finish_anim(self):
+        self.trees = self.worker.trees
+        if self.values is not self.worker.values:
+            for tree in self.trees:
+                tree.restyle(self.values)
+        self.cancel_anim()
+        self.fit_rect = self.scene_bounds.scene_rect()
+        for buckets in self.buckets.values():
+            buckets.remove()
+        self.buckets = {}
+        self.fit_and_draw_lod()
+        d = GrassDrawer(self.scene, random.Random(self.seed), self.fit_rect, self.stats)
+        d.draw_some_grass(150 + 75*self.values["tree_count"])
+        self.show_progress("Done. Displayed frame: {0}, seed: {1}".format(self.index, self.seed))
+
+    def fit_and_draw_lod(self):
+        self.ui.image.fitInView(self.fit_rect, 1)
+        pixel_size = 1.0 / self.ui.image.transform().m11()
+        for tree in self.trees:
+            tree.draw_lod(self.scene, pixel_size)
 
-        self.ui.image.fitInView(self.scene.itemsBoundingRect(), 1)
-        d = GrassDrawer(self.ui.image)
-        d.draw_some_grass(150 + 75*tree_count)
-        #self.ui.image.fitInView(self.scene.itemsBoundingRect(), 1)
-        self.ui.progress.setText("Done. Displayed frame: {0}".format(index))
+    def resizeEvent(self, event):
+        QDialog.resizeEvent(self, event)
+        if self.fit_rect is not None:
+            self.fit_and_draw_lod()
 
 def aboutToQuit():
+    window.cancel_anim()
     # Prevents a crash, probably a bug in pyqt
     window.ui.image.deleteLater()
     window.close()
@@ -308,7 +1424,7 @@ def aboutToQuit():
 if __name__ == '__main__':
     import sys
     app = QApplication(sys.argv)
-    window = TreeDialog()
+    window = TreeDialog(profile="--stats" in sys.argv)
     window.show()
     window.new_anim()
     app.setActiveWindow(window)